@@ -1,15 +1,39 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
-from datetime import datetime, date
+from pymongo import ASCENDING, DESCENDING, DeleteOne, MongoClient, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, OperationFailure, PyMongoError
+from bson import ObjectId
+from bson.errors import InvalidId
+from pydantic import BaseModel, Field, ValidationError
+from typing import List, Literal, Optional, Dict, Any
+from datetime import datetime, date, timedelta
 import os
+import sys
+import asyncio
 import uuid
-import io
-from fastapi.responses import StreamingResponse
+import json
+import base64
+import tempfile
+import hashlib
+import math
+import time
+import multiprocessing
+import threading
+from bisect import bisect_right
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+import numpy as np
 import openpyxl
+import pyarrow as pa
+import pyarrow.parquet as pq
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, Alignment, PatternFill
+from openpyxl.utils import get_column_letter
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Gauge, Histogram, Counter as MetricCounter, generate_latest
+from prometheus_client import multiprocess
 import logging
 
 app = FastAPI()
@@ -21,14 +45,402 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
 
+# Prometheus metrics, served at /metrics. Routes are labelled by their path
+# template so per-id URLs do not create a series each. With several worker
+# processes set PROMETHEUS_MULTIPROC_DIR and every worker's samples are merged.
+HTTP_REQUESTS = MetricCounter(
+    "http_requests_total", "HTTP requests handled", ["method", "route", "status"]
+)
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Time to send the full HTTP response", ["method", "route"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+HTTP_REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "HTTP requests being handled", ["method"], multiprocess_mode="livesum"
+)
+MONGO_POOL_CHECKOUT_WAIT = Histogram(
+    "mongodb_pool_checkout_wait_seconds", "Time spent waiting for a pooled connection", ["outcome"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10),
+)
+MONGO_COMMAND_DURATION = Histogram(
+    "mongodb_command_duration_seconds", "MongoDB command round trip time", ["command", "outcome"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+EXPORT_DURATION = Histogram(
+    "export_duration_seconds", "Excel workbook build time in the export pool", ["kind", "outcome"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+
+class MetricsMiddleware:
+    """Count and time every HTTP request, including streamed response bodies."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        method = scope["method"]
+        in_flight = HTTP_REQUESTS_IN_FLIGHT.labels(method)
+        in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            in_flight.dec()
+            # The router stores the matched route in the scope
+            route = scope.get("route")
+            template = route.path if route else "unmatched"
+            HTTP_REQUEST_DURATION.labels(method, template).observe(time.perf_counter() - started)
+            HTTP_REQUESTS.labels(method, template, str(status)).inc()
+
+app.add_middleware(MetricsMiddleware)
+
+# Slow request profiling, opt in with PROFILE_SLOW_REQUEST_MS. While requests
+# are in flight a sampler thread records the event loop thread's stack every
+# PROFILE_SAMPLE_INTERVAL_MS, and the MongoDB command listener keeps the
+# commands it sees. A request that runs past the threshold gets the samples
+# and commands from its time window saved to a ring buffer that
+# /api/admin/profiles serves. Requests share the event loop, so a window can
+# include work for overlapping requests; each profile reports how many there
+# were.
+PROFILE_SLOW_REQUEST_MS = float(os.environ.get("PROFILE_SLOW_REQUEST_MS", 0))
+PROFILE_SAMPLE_INTERVAL_MS = float(os.environ.get("PROFILE_SAMPLE_INTERVAL_MS", 5))
+PROFILE_BUFFER_SIZE = int(os.environ.get("PROFILE_BUFFER_SIZE", 50))
+PROFILE_MAX_STACK_DEPTH = 64
+PROFILE_TOP_STACKS = 25
+PROFILE_MAX_COMMANDS = 200
+
+def sample_stack(frame):
+    stack = []
+    while frame is not None and len(stack) < PROFILE_MAX_STACK_DEPTH:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+class SlowRequestProfiler:
+    def __init__(self, threshold_ms, interval_ms, buffer_size):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self.profiles = deque(maxlen=buffer_size)
+        self.samples = deque()
+        self.commands = deque()
+        self.active = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.loop_thread = None
+
+    def start(self):
+        self.loop_thread = threading.get_ident()
+        threading.Thread(target=self.run, name="slow-request-profiler", daemon=True).start()
+
+    def run(self):
+        while True:
+            self.wake.wait()
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is not None:
+                stack = sample_stack(frame)
+                with self.lock:
+                    self.samples.append((time.perf_counter(), stack))
+            del frame
+            time.sleep(self.interval)
+
+    def record_command(self, event, outcome):
+        if not self.active:
+            return
+        duration = event.duration_micros / 1e6
+        with self.lock:
+            self.commands.append((time.perf_counter() - duration, event.command_name, duration, outcome))
+
+    def begin(self):
+        token = object()
+        with self.lock:
+            for entry in self.active.values():
+                entry['overlapping'] += 1
+            self.active[token] = {"started": time.perf_counter(), "overlapping": len(self.active)}
+        self.wake.set()
+        return token
+
+    def end(self, token, scope, status):
+        finished = time.perf_counter()
+        with self.lock:
+            entry = self.active.pop(token)
+            started = entry['started']
+            slow = finished - started >= self.threshold
+            samples = [stack for at, stack in self.samples if at >= started] if slow else []
+            commands = [command for command in self.commands if command[0] + command[2] >= started] if slow else []
+            # Keep only what the oldest request still in flight may need
+            cutoff = min((other['started'] for other in self.active.values()), default=finished)
+            while self.samples and self.samples[0][0] < cutoff:
+                self.samples.popleft()
+            while self.commands and self.commands[0][0] + self.commands[0][2] < cutoff:
+                self.commands.popleft()
+            if not self.active:
+                self.wake.clear()
+        if slow:
+            self.profiles.append(self.build_profile(scope, status, started, finished, entry, samples, commands))
+
+    def build_profile(self, scope, status, started, finished, entry, samples, commands):
+        route = scope.get("route")
+        stacks = Counter(samples)
+        leaves = Counter(stack[-1] for stack in samples if stack)
+        return {
+            "profile_id": str(uuid.uuid4()),
+            "method": scope["method"],
+            "path": scope["path"],
+            "query": scope.get("query_string", b"").decode("latin-1"),
+            "route": route.path if route else None,
+            "status": status,
+            "captured_at": datetime.now().isoformat(),
+            "duration_ms": round((finished - started) * 1000, 3),
+            "overlapping_requests": entry['overlapping'],
+            "sample_interval_ms": self.interval * 1000,
+            "samples": len(samples),
+            "stacks": [
+                {"stack": ";".join(stack), "samples": count}
+                for stack, count in stacks.most_common(PROFILE_TOP_STACKS)
+            ],
+            "hot_frames": [
+                {"frame": frame, "samples": count} for frame, count in leaves.most_common(PROFILE_TOP_STACKS)
+            ],
+            "mongo_commands": [
+                {
+                    "command": name,
+                    "offset_ms": round((command_started - started) * 1000, 3),
+                    "duration_ms": round(duration * 1000, 3),
+                    "outcome": outcome,
+                }
+                for command_started, name, duration, outcome in sorted(commands)[:PROFILE_MAX_COMMANDS]
+            ],
+            "mongo_commands_total": len(commands),
+            "mongo_time_ms": round(sum(command[2] for command in commands) * 1000, 3),
+        }
+
+profiler = (
+    SlowRequestProfiler(PROFILE_SLOW_REQUEST_MS, PROFILE_SAMPLE_INTERVAL_MS, PROFILE_BUFFER_SIZE)
+    if PROFILE_SLOW_REQUEST_MS else None
+)
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        token = profiler.begin()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            profiler.end(token, scope, status)
+
+if profiler:
+    app.add_middleware(ProfilingMiddleware)
+
+class MongoPoolMonitor(monitoring.ConnectionPoolListener):
+    """Connection counts and checkout waits for /api/ready and /metrics.
+
+    Checkouts block the driver thread that asked for the connection, so the
+    start time is kept per thread.
+    """
+
+    def __init__(self, window=1000):
+        self.checkout_started = threading.local()
+        self.waits = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.open = 0
+        self.in_use = 0
+        self.checkouts = 0
+        self.failed = 0
+        self.cleared = 0
+
+    def _finish_checkout(self, outcome):
+        wait = time.perf_counter() - getattr(self.checkout_started, "at", time.perf_counter())
+        MONGO_POOL_CHECKOUT_WAIT.labels(outcome).observe(wait)
+        with self.lock:
+            self.waits.append(wait)
+            if outcome == "succeeded":
+                self.checkouts += 1
+                self.in_use += 1
+            else:
+                self.failed += 1
+
+    def connection_check_out_started(self, event):
+        self.checkout_started.at = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        self._finish_checkout("succeeded")
+
+    def connection_check_out_failed(self, event):
+        self._finish_checkout("failed")
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.in_use -= 1
+
+    def connection_created(self, event):
+        with self.lock:
+            self.open += 1
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.open -= 1
+
+    def pool_cleared(self, event):
+        with self.lock:
+            self.cleared += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def snapshot(self):
+        with self.lock:
+            waits = sorted(self.waits)
+            stats = {
+                "connections_open": self.open,
+                "connections_in_use": self.in_use,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.failed,
+                "pool_clears": self.cleared,
+            }
+        if waits:
+            stats["checkout_wait_ms"] = {
+                "p50": waits[len(waits) // 2] * 1000,
+                "p95": waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000,
+                "max": waits[-1] * 1000,
+                "window": len(waits),
+            }
+        return stats
+
+pool_monitor = MongoPoolMonitor()
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_COMMAND_DURATION.labels(event.command_name, "succeeded").observe(event.duration_micros / 1e6)
+        if profiler:
+            profiler.record_command(event, "succeeded")
+
+    def failed(self, event):
+        MONGO_COMMAND_DURATION.labels(event.command_name, "failed").observe(event.duration_micros / 1e6)
+        if profiler:
+            profiler.record_command(event, "failed")
+
 # MongoDB connection (validate at startup)
 logger = logging.getLogger("uvicorn.error")
 
 MONGO_URL = os.environ.get('MONGO_URL')
+MONGO_DB_NAME = os.environ.get('MONGO_DB_NAME', 'painting_contractor_db')
+# Connection pool. waitQueueTimeoutMS makes a request fail fast rather than
+# queue forever when a burst exhausts the pool; minPoolSize connections are
+# opened at startup so the first burst does not pay for the handshakes.
+MONGO_POOL_OPTIONS = {
+    "maxPoolSize": int(os.environ.get('MONGO_MAX_POOL_SIZE', 100)),
+    "minPoolSize": int(os.environ.get('MONGO_MIN_POOL_SIZE', 10)),
+    "maxIdleTimeMS": int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', 300000)),
+    "waitQueueTimeoutMS": int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 10000)),
+}
 client = None
 db = None
+# Multi-document transactions need a replica set or mongos; set at startup
+transactions_supported = False
+
+# Declarative index registry. Every lookup and sort used by the routes below
+# must be backed by one of these; ensure_indexes() applies them idempotently
+# at startup and /api/admin/indexes reports which ones are missing.
+INDEX_SPECS = [
+    {"collection": "sites", "keys": [("site_id", ASCENDING)], "unique": True},
+    {"collection": "materials", "keys": [("material_id", ASCENDING)], "unique": True},
+    {"collection": "labours", "keys": [("labour_id", ASCENDING)], "unique": True},
+    {"collection": "site_daily_logs", "keys": [("log_id", ASCENDING)], "unique": True},
+    {"collection": "site_daily_logs", "keys": [("site_id", ASCENDING), ("log_date", DESCENDING), ("_id", DESCENDING)]},
+    {"collection": "site_daily_logs", "keys": [("log_date", DESCENDING), ("_id", DESCENDING)]},
+    {"collection": "site_daily_logs", "keys": [("materials_used.material_id", ASCENDING), ("log_date", ASCENDING), ("_id", ASCENDING)]},
+    {"collection": "site_daily_logs", "keys": [("labours_used.labour_id", ASCENDING), ("log_date", ASCENDING), ("_id", ASCENDING)]},
+    {"collection": "overheads", "keys": [("overhead_id", ASCENDING)], "unique": True},
+    {"collection": "overheads", "keys": [("site_id", ASCENDING), ("date", DESCENDING), ("_id", DESCENDING)]},
+    {"collection": "overheads", "keys": [("date", DESCENDING), ("_id", DESCENDING)]},
+    {"collection": "site_cost_rollups", "keys": [("site_id", ASCENDING)], "unique": True},
+    {"collection": "stock_movements", "keys": [("material_id", ASCENDING), ("date", ASCENDING), ("_id", ASCENDING)]},
+    {"collection": "stock_snapshots", "keys": [("material_id", ASCENDING), ("as_of", DESCENDING)], "unique": True},
+    {"collection": "sites", "keys": [("updated_seq", ASCENDING), ("_id", ASCENDING)]},
+    {"collection": "materials", "keys": [("updated_seq", ASCENDING), ("_id", ASCENDING)]},
+    {"collection": "labours", "keys": [("updated_seq", ASCENDING), ("_id", ASCENDING)]},
+    {"collection": "site_daily_logs", "keys": [("updated_seq", ASCENDING), ("_id", ASCENDING)]},
+    {"collection": "overheads", "keys": [("updated_seq", ASCENDING), ("_id", ASCENDING)]},
+    {"collection": "tombstones", "keys": [("updated_seq", ASCENDING), ("_id", ASCENDING)]},
+    {"collection": "daily_cost_facts", "keys": [("date", ASCENDING), ("site_id", ASCENDING), ("cost_type", ASCENDING), ("category", ASCENDING)], "unique": True},
+    {"collection": "daily_cost_facts", "keys": [("site_id", ASCENDING), ("date", ASCENDING)]},
+    {"collection": "rate_history", "keys": [("kind", ASCENDING), ("item_id", ASCENDING), ("effective_from", ASCENDING)], "unique": True},
+]
+
+
+def _index_name(keys):
+    # Same naming scheme MongoDB uses for unnamed indexes (e.g. "site_id_1_log_date_-1")
+    return "_".join(f"{field}_{direction}" for field, direction in keys)
+
+
+async def ensure_indexes():
+    """Create every index in INDEX_SPECS and drop the ones it no longer lists.
+
+    Safe to run on every startup. A failing index (for example a unique index
+    over existing duplicate ids) is logged and skipped so it cannot take the
+    whole API down; it will show up as missing in /api/admin/indexes, and its
+    collection keeps its other indexes until it can be built.
+    """
+    failed = set()
+    for spec in INDEX_SPECS:
+        name = _index_name(spec["keys"])
+        try:
+            await db[spec["collection"]].create_index(spec["keys"], name=name, unique=spec.get("unique", False))
+        except OperationFailure as e:
+            failed.add(spec["collection"])
+            logger.error("Failed to create index %s on %s: %s", name, spec["collection"], e)
+
+    # Superseded indexes (e.g. from before a sort gained its _id tie-breaker)
+    # would otherwise be maintained on every write
+    for collection in {spec["collection"] for spec in INDEX_SPECS} - failed:
+        expected = {_index_name(spec["keys"]) for spec in INDEX_SPECS if spec["collection"] == collection}
+        for name in await db[collection].index_information():
+            if name != "_id_" and name not in expected:
+                try:
+                    await db[collection].drop_index(name)
+                    logger.info("Dropped index %s on %s: not in INDEX_SPECS", name, collection)
+                except OperationFailure as e:
+                    logger.error("Failed to drop index %s on %s: %s", name, collection, e)
 
 
 @app.on_event("startup")
@@ -38,23 +450,55 @@ async def startup_event():
     This prints/logs a clear error so hosting logs (Render) show the reason
     if the service fails to start (missing/invalid MONGO_URL or network error).
     """
-    global client, db
+    global client, db, transactions_supported, export_pool
     if not MONGO_URL:
         logger.error("MONGO_URL environment variable is not set. Set MONGO_URL on your host.")
         raise RuntimeError("MONGO_URL environment variable is not set")
 
     try:
         # Use a short server selection timeout so failures surface quickly in logs
-        client = AsyncIOMotorClient(MONGO_URL, serverSelectionTimeoutMS=5000)
+        client = AsyncIOMotorClient(
+            MONGO_URL,
+            serverSelectionTimeoutMS=5000,
+            event_listeners=[MongoCommandMetrics(), pool_monitor],
+            **MONGO_POOL_OPTIONS,
+        )
         # Verify connection with a ping
         await client.admin.command('ping')
-        db = client.painting_contractor_db
+        # Warm the pool: concurrent pings each need their own connection
+        await asyncio.gather(*(client.admin.command('ping') for _ in range(MONGO_POOL_OPTIONS['minPoolSize'])))
+        db = client[MONGO_DB_NAME]
         logger.info("Successfully connected to MongoDB")
+        hello = await client.admin.command('hello')
+        transactions_supported = "setName" in hello or hello.get("msg") == "isdbgrid"
+        if not transactions_supported:
+            logger.warning("MongoDB is a standalone server; multi-document writes will run without transactions")
     except Exception as e:
         logger.exception("Failed to connect to MongoDB: %s", e)
         # Re-raise to stop application startup and make the error visible in platform logs
         raise
 
+    await ensure_indexes()
+    await ensure_opening_rates()
+    await ensure_opening_movements()
+    await ensure_sync_seqs()
+
+    if profiler:
+        profiler.start()
+
+    os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+    export_pool = ProcessPoolExecutor(
+        max_workers=EXPORT_MAX_WORKERS, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if export_pool:
+        export_pool.shutdown(wait=False, cancel_futures=True)
+    if client:
+        client.close()
+
 # Pydantic Models
 class Site(BaseModel):
     site_id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -67,6 +511,7 @@ class Site(BaseModel):
     start_date: str
     status: str = "Running"  # Running, Completed, On Hold
     created_at: str = Field(default_factory=lambda: datetime.now().isoformat())
+    updated_seq: Optional[int] = None  # set by the server on every write
 
     class Config:
         json_schema_extra = {
@@ -89,6 +534,7 @@ class Material(BaseModel):
     rate_per_unit: float
     current_stock: float
     created_at: str = Field(default_factory=lambda: datetime.now().isoformat())
+    updated_seq: Optional[int] = None  # set by the server on every write
 
     class Config:
         json_schema_extra = {
@@ -105,6 +551,7 @@ class Labour(BaseModel):
     name: str
     rate_per_day: float
     created_at: str = Field(default_factory=lambda: datetime.now().isoformat())
+    updated_seq: Optional[int] = None  # set by the server on every write
 
     class Config:
         json_schema_extra = {
@@ -118,15 +565,15 @@ class MaterialUsed(BaseModel):
     material_id: str
     material_name: str
     quantity: float
-    rate_per_unit: float
-    total_cost: float
+    rate_per_unit: Optional[float] = None  # None: the material's rate on log_date
+    total_cost: float = 0.0  # computed by the server
 
 class LabourUsed(BaseModel):
     labour_id: str
     labour_name: str
     count: int
-    rate_per_day: float
-    total_cost: float
+    rate_per_day: Optional[float] = None  # None: the labourer's rate on log_date
+    total_cost: float = 0.0  # computed by the server
 
 class SiteDailyLog(BaseModel):
     log_id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -140,6 +587,7 @@ class SiteDailyLog(BaseModel):
     total_labour_cost: float = 0.0
     total_cost: float = 0.0
     created_at: str = Field(default_factory=lambda: datetime.now().isoformat())
+    updated_seq: Optional[int] = None  # set by the server on every write
 
 class Overhead(BaseModel):
     overhead_id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -150,6 +598,23 @@ class Overhead(BaseModel):
     amount: float
     description: Optional[str] = None
     created_at: str = Field(default_factory=lambda: datetime.now().isoformat())
+    updated_seq: Optional[int] = None  # set by the server on every write
+
+class StockMovement(BaseModel):
+    movement_id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    material_id: str
+    date: str
+    delta: float
+    reason: str  # opening, adjustment, site_log, site_log_reversal
+    log_id: Optional[str] = None
+    site_id: Optional[str] = None
+    created_at: str = Field(default_factory=lambda: datetime.now().isoformat())
+
+class RepriceRequest(BaseModel):
+    rate: float = Field(ge=0)  # new rate_per_unit or rate_per_day
+    from_date: str
+    to_date: Optional[str] = None
+    dry_run: bool = False
 
 # Helper function to serialize MongoDB documents
 def serialize_doc(doc):
@@ -157,382 +622,2140 @@ def serialize_doc(doc):
         doc.pop('_id')
     return doc
 
+# Keyset pagination. Every list endpoint sorts on its existing key with _id as
+# the tie-breaker, so a cursor is just the sort values of the last row served.
+MAX_PAGE_SIZE = 1000
+
+SITE_SORT = [("_id", ASCENDING)]
+MATERIAL_SORT = [("_id", ASCENDING)]
+LABOUR_SORT = [("_id", ASCENDING)]
+SITE_LOG_SORT = [("log_date", DESCENDING), ("_id", DESCENDING)]
+OVERHEAD_SORT = [("date", DESCENDING), ("_id", DESCENDING)]
+STOCK_MOVEMENT_SORT = [("date", ASCENDING), ("_id", ASCENDING)]
+
+def encode_cursor(doc, sort):
+    values = [doc[field] for field, _ in sort]
+    values[-1] = str(values[-1])
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+def decode_cursor(token, sort):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        if not isinstance(values, list) or len(values) != len(sort):
+            raise ValueError(token)
+        values[-1] = ObjectId(values[-1])
+    except (ValueError, TypeError, InvalidId):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+def keyset_filter(sort, values):
+    """Match rows strictly after `values` in `sort` order."""
+    clauses = []
+    for i, (field, direction) in enumerate(sort):
+        clause = {prefix: value for (prefix, _), value in zip(sort[:i], values[:i])}
+        clause[field] = {"$gt" if direction == ASCENDING else "$lt": values[i]}
+        clauses.append(clause)
+    return {"$or": clauses}
+
+def parse_fields(fields, model):
+    if not fields:
+        return None
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in model.model_fields]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return requested
+
+def list_cursor(collection, query, sort, after=None, fields=None):
+    if after:
+        query = {"$and": [query, keyset_filter(sort, decode_cursor(after, sort))]}
+    projection = None
+    if fields:
+        # Sort keys are always fetched so the next cursor can be built
+        projection = dict.fromkeys(fields + [field for field, _ in sort], 1)
+    return collection.find(query, projection).sort(sort)
+
+# Reference data cache. Materials and labours are small catalogs that every
+# site-log form reads, so their list pages are served from process memory.
+# Pages are keyed by the collection's data version, the same number the ETag
+# is built from, so a write in any worker makes the old pages unreachable and
+# a cached body is never sent under a newer ETag. Entries expire after
+# REFERENCE_CACHE_TTL_SECONDS and the least recently used are dropped past
+# REFERENCE_CACHE_MAX_ENTRIES.
+REFERENCE_CACHE_TTL_SECONDS = float(os.environ.get("REFERENCE_CACHE_TTL_SECONDS", 60))
+REFERENCE_CACHE_MAX_ENTRIES = int(os.environ.get("REFERENCE_CACHE_MAX_ENTRIES", 256))
+
+class ReferenceCache:
+    """TTL + LRU cache of list pages keyed by (collection, ...)."""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.stats = {}
+
+    def _stats(self, collection):
+        return self.stats.setdefault(collection, {"hits": 0, "misses": 0})
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            self._stats(key[0])['hits'] += 1
+            return entry[1]
+        self.entries.pop(key, None)
+        self._stats(key[0])['misses'] += 1
+        return None
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def snapshot(self):
+        sizes = Counter(key[0] for key in self.entries)
+        return {
+            collection: {**stats, "entries": sizes.get(collection, 0)}
+            for collection, stats in self.stats.items()
+        }
+
+reference_cache = ReferenceCache(REFERENCE_CACHE_TTL_SECONDS, REFERENCE_CACHE_MAX_ENTRIES)
+async def fetch_page(collection, query, sort, model, limit=None, after=None, fields=None, cache=None, version=None):
+    """Return (requested fields, docs, next cursor) for one page of a list query.
+
+    With a cache, `version` is the collection's data version as already read
+    for the ETag; it is looked up here when the caller has none.
+    """
+    requested = parse_fields(fields, model)
+    if cache:
+        if version is None:
+            version = await data_version(collection.name)
+        key = (collection.name, version, json.dumps(query, sort_keys=True, default=str), limit, after, fields)
+        page = cache.get(key)
+        if page is not None:
+            return page
+
+    cursor = list_cursor(collection, query, sort, after, requested)
+    if limit:
+        cursor = cursor.limit(limit + 1)
+    docs = await cursor.to_list(length=None)
+
+    next_cursor = None
+    if limit and len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = encode_cursor(docs[-1], sort)
+    page = (requested, [serialize_doc(doc) for doc in docs], next_cursor)
+    if cache:
+        cache.put(key, page)
+    return page
+
+async def paginate(response, collection, query, sort, model, limit=None, after=None, fields=None, cache=None,
+                   version=None):
+    """Run a list query one page at a time.
+
+    Without `limit` the whole (remaining) result is returned as before. With
+    `limit`, one extra row is read to decide whether an X-Next-Cursor header
+    is needed. A `fields` projection bypasses the endpoint's response_model,
+    since partial documents would not validate against it.
+    """
+    requested, docs, next_cursor = await fetch_page(collection, query, sort, model, limit, after, fields, cache, version)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+
+    if requested is None:
+        return docs
+    return JSONResponse(
+        content=[{field: doc[field] for field in requested if field in doc} for doc in docs],
+        headers=dict(response.headers),
+    )
+
+# NDJSON streaming for bulk readers: rows go out batch by batch straight from
+# the Mongo cursor, skipping list building and response_model validation.
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+STREAM_BATCH_SIZE = 500
+
+def wants_ndjson(request, stream):
+    return stream or NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+def stream_ndjson(collection, query, sort, model, limit=None, after=None, fields=None):
+    # Validate parameters before the response starts so errors still get a 400
+    requested = parse_fields(fields, model)
+    cursor = list_cursor(collection, query, sort, after, requested).batch_size(STREAM_BATCH_SIZE)
+    if limit:
+        cursor = cursor.limit(limit)
+
+    async def lines():
+        batch = []
+        async for doc in cursor:
+            doc = serialize_doc(doc)
+            if requested is not None:
+                doc = {field: doc[field] for field in requested if field in doc}
+            batch.append(json.dumps(doc))
+            if len(batch) >= STREAM_BATCH_SIZE:
+                yield "\n".join(batch) + "\n"
+                batch = []
+        if batch:
+            yield "\n".join(batch) + "\n"
+
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE)
+
+async def run_in_transaction(callback):
+    """Run `callback(session, seq)` inside a multi-document transaction.
+
+    Motor's with_transaction retries the whole callback on transient errors
+    and retries the commit on unknown commit results, so callbacks must do all
+    of their reads and writes through the session they are given. On a
+    standalone server the callback runs once with session=None.
+
+    seq is reserved before the transaction starts and is the same on every
+    retry. The shared counter and data_versions documents are never written
+    inside a transaction, so two writes only conflict when they touch the
+    same log, stock or rollup; callers bump data versions after this returns.
+    """
+    async with reserve_seq() as seq:
+        if not transactions_supported:
+            return await callback(None, seq)
+        async with await client.start_session() as session:
+            return await session.with_transaction(lambda session: callback(session, seq))
+
+def compute_log_totals(log_dict):
+    """Price every line and total the log; call rate_index.refresh() first.
+
+    Lines sent without a rate take the item's rate on the log date. Line
+    costs are always computed here; client-sent total_cost is ignored.
+    """
+    for kind, (field, id_key, quantity_key, rate_key) in COST_LINE_FIELDS.items():
+        for line in log_dict[field]:
+            if line[rate_key] is None:
+                line[rate_key] = rate_index.rate_at(kind, line[id_key], log_dict['log_date'])
+                if line[rate_key] is None:
+                    raise ValueError(f"No {kind} rate for {line[id_key]} on {log_dict['log_date']}")
+            line['total_cost'] = line[quantity_key] * line[rate_key]
+    material_cost = sum(m['total_cost'] for m in log_dict['materials_used'])
+    labour_cost = sum(l['total_cost'] for l in log_dict['labours_used'])
+    log_dict['total_material_cost'] = material_cost
+    log_dict['total_labour_cost'] = labour_cost
+    log_dict['total_cost'] = material_cost + labour_cost
+    return log_dict
+
+async def price_log(log_dict):
+    await rate_index.refresh()
+    try:
+        return compute_log_totals(log_dict)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def add_deltas(total, deltas):
+    """Accumulate {key: number} or {key: {field: number}} deltas into total."""
+    for key, value in deltas.items():
+        if isinstance(value, dict):
+            add_deltas(total.setdefault(key, {}), value)
+        else:
+            total[key] = total.get(key, 0) + value
+    return total
+
+# Data versions. Writers bump a counter per scope ("site:<site_id>" for a
+# site's details, logs and overheads; "materials" for the catalog and its
+# stock; "sites", "labours", "site_logs" and "overheads" for those
+# collections), so derived artifacts such as cached exports and ETags can tell
+# whether their inputs changed without reading the data itself. Versions are
+# bumped after a write commits: a reader in between can only pair the old
+# version with new data, which the next bump invalidates. updated_at is the
+# time of the latest bump, i.e. how current anything built on the version is.
+async def bump_versions(scopes):
+    if not scopes:
+        return
+    now = datetime.now()
+    await db.data_versions.bulk_write(
+        [UpdateOne({"_id": scope}, {"$inc": {"version": 1}, "$set": {"updated_at": now}}, upsert=True)
+         for scope in scopes],
+        ordered=False,
+    )
+
+async def data_version(scope):
+    doc = await db.data_versions.find_one({"_id": scope})
+    return doc['version'] if doc else 0
+
+def log_version_scopes(*logs):
+    scopes = {"site_logs"} | {f"site:{log['site_id']}" for log in logs if log}
+    if any(log and log['materials_used'] for log in logs):
+        scopes.add("materials")
+    return scopes
+
+def overhead_version_scopes(*overheads):
+    return {"overheads"} | {f"site:{overhead['site_id']}" for overhead in overheads if overhead}
+
+# Conditional GETs. A read endpoint's ETag is a hash of its URL and the data
+# versions of the scopes it reads, so deciding on 304 Not Modified costs one
+# indexed lookup in data_versions instead of running the query.
+async def scope_versions(scopes):
+    docs = await db.data_versions.find({"_id": {"$in": list(scopes)}}).to_list(length=None)
+    versions = {doc['_id']: doc['version'] for doc in docs}
+    return {scope: versions.get(scope, 0) for scope in scopes}
+
+def versions_etag(request, versions):
+    source = f"{request.url.path}?{request.url.query}:" + ",".join(
+        f"{scope}={versions[scope]}" for scope in sorted(versions)
+    )
+    return f'"{hashlib.sha256(source.encode()).hexdigest()[:32]}"'
+
+def not_modified(request, etag):
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    return header.strip() == "*" or etag in [tag.strip() for tag in header.split(",")]
+
+async def check_etag(request, response, scopes):
+    """Set the ETag header for `scopes`, or raise 304 if the client already has it.
+
+    Returns the data versions the tag was built from.
+    """
+    versions = await scope_versions(scopes)
+    etag = versions_etag(request, versions)
+    if not_modified(request, etag):
+        raise HTTPException(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return versions
+
+# Change sequence for delta sync. Every write takes a value of a global
+# counter and stamps it on the documents it touches as updated_seq; deletes
+# leave a tombstone with the same stamp. Seqs are reserved in blocks outside
+# any transaction, so they can commit out of order; every write brackets
+# itself with reserve_seq, and sync never moves a client past a write still
+# in flight. Tombstones older than SYNC_HISTORY_DAYS are pruned, and a client
+# that last synced before that starts over from a full copy.
+SYNC_PENDING_TIMEOUT_SECONDS = int(os.environ.get("SYNC_PENDING_TIMEOUT_SECONDS", 300))
+SYNC_HISTORY_DAYS = int(os.environ.get("SYNC_HISTORY_DAYS", 30))
+SEQ_BLOCK_SIZE = int(os.environ.get("SEQ_BLOCK_SIZE", 100))
+SEQ_BLOCK_SECONDS = float(os.environ.get("SEQ_BLOCK_SECONDS", 1))
+SYNC_SORT = [("updated_seq", ASCENDING), ("_id", ASCENDING)]
+# Sync name -> collection
+SYNC_COLLECTIONS = {
+    "sites": "sites",
+    "materials": "materials",
+    "labours": "labours",
+    "site_logs": "site_daily_logs",
+    "overheads": "overheads",
+}
+
+class SeqBlocks:
+    """Hands out seqs from blocks of SEQ_BLOCK_SIZE reserved in one update.
+
+    Reserving a block adds SEQ_BLOCK_SIZE to the counter and, in the same
+    update, records the block under `pending` with the counter value before
+    it (its floor). Overlapping writes share a block; once none of them is
+    running the block is released and its unused seqs are skipped. A block
+    stops handing out seqs after SEQ_BLOCK_SECONDS, so a steady stream of
+    overlapping writes cannot hold the sync watermark back.
+    """
+
+    def __init__(self):
+        self.block = None
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Return (block, seq); pass the block to release() once the write is done."""
+        async with self.lock:
+            block = self.block
+            if block is None or block['next'] > block['last'] or time.monotonic() > block['expires']:
+                block = self.block = await self.reserve()
+            seq = block['next']
+            block['next'] += 1
+            block['holders'] += 1
+        return block, seq
+
+    async def reserve(self):
+        block_id = str(ObjectId())
+        value = {"$ifNull": ["$value", 0]}
+        counter = await db.counters.find_one_and_update(
+            {"_id": "updated_seq"},
+            [{"$set": {
+                "value": {"$add": [value, SEQ_BLOCK_SIZE]},
+                f"pending.{block_id}": {"floor": value, "started_at": {"$literal": datetime.utcnow()}},
+            }}],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return {
+            "id": block_id,
+            "next": counter['value'] - SEQ_BLOCK_SIZE + 1,
+            "last": counter['value'],
+            "expires": time.monotonic() + SEQ_BLOCK_SECONDS,
+            "holders": 0,
+        }
+
+    async def release(self, block):
+        block['holders'] -= 1
+        if block['holders']:
+            return
+        if self.block is block:
+            self.block = None
+        await db.counters.update_one({"_id": "updated_seq"}, {"$unset": {f"pending.{block['id']}": ""}})
+
+seq_blocks = SeqBlocks()
+
+@asynccontextmanager
+async def reserve_seq():
+    """Take a seq for a write and yield it until the write is done.
+
+    The seq's block stays pending until every write holding one of its seqs
+    is done, so sync_watermark() cannot pass this seq before its documents
+    are visible.
+    """
+    block, seq = await seq_blocks.acquire()
+    try:
+        yield seq
+    finally:
+        await seq_blocks.release(block)
+
+def stale_block_cutoff():
+    return datetime.utcnow() - timedelta(seconds=SYNC_PENDING_TIMEOUT_SECONDS)
+
+async def sync_watermark():
+    """Highest seq whose writes are all visible; what /api/sync hands out.
+
+    Blocks left pending by a crashed writer are ignored after
+    SYNC_PENDING_TIMEOUT_SECONDS.
+    """
+    counter = await db.counters.find_one({"_id": "updated_seq"}) or {}
+    cutoff = stale_block_cutoff()
+    floors = [block['floor'] for block in counter.get('pending', {}).values() if block['started_at'] > cutoff]
+    return min([counter.get('value', 0), *floors])
+
+async def pruned_seq():
+    counter = await db.counters.find_one({"_id": "tombstones_pruned"})
+    return counter['value'] if counter else 0
+
+async def prune_sync_history():
+    """Delete tombstones older than SYNC_HISTORY_DAYS and blocks left pending by crashed writers.
+
+    Meant to run periodically, e.g. nightly via `python server.py prune-sync`.
+    The newest pruned seq is recorded first, so a client still behind it gets
+    410 from /api/sync instead of silently missing deletes.
+    """
+    cutoff = (datetime.now() - timedelta(days=SYNC_HISTORY_DAYS)).isoformat()
+    newest = await db.tombstones.find_one({"deleted_at": {"$lt": cutoff}}, sort=[("updated_seq", DESCENDING)])
+    pruned = 0
+    if newest:
+        await db.counters.update_one(
+            {"_id": "tombstones_pruned"}, {"$max": {"value": newest['updated_seq']}}, upsert=True
+        )
+        pruned = (await db.tombstones.delete_many({"updated_seq": {"$lte": newest['updated_seq']}})).deleted_count
+    counter = await db.counters.find_one({"_id": "updated_seq"}) or {}
+    cutoff = stale_block_cutoff()
+    stale = [block_id for block_id, block in counter.get('pending', {}).items() if block['started_at'] <= cutoff]
+    if stale:
+        await db.counters.update_one({"_id": "updated_seq"}, {"$unset": {f"pending.{block_id}": "" for block_id in stale}})
+    return {"pruned_tombstones": pruned, "pruned_seq": await pruned_seq(), "stale_blocks": len(stale)}
+
+async def ensure_sync_seqs():
+    """Stamp documents written before delta sync existed with updated_seq 0, so full syncs page over them."""
+    stamped = 0
+    for collection in SYNC_COLLECTIONS.values():
+        result = await db[collection].update_many({"updated_seq": None}, {"$set": {"updated_seq": 0}})
+        stamped += result.modified_count
+    return stamped
+
+def encode_sync_cursor(since, seq, stream, last=None):
+    values = [since, seq, stream, *([last['updated_seq'], str(last['_id'])] if last else [])]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+def decode_sync_cursor(token, since):
+    """Return (seq, stream, last sort values or None) from a /api/sync cursor issued for `since`."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        if not isinstance(values, list) or len(values) not in (3, 5) or not all(isinstance(v, int) for v in values[:3]):
+            raise ValueError(token)
+        last = [values[3], ObjectId(values[4])] if len(values) == 5 else None
+    except (ValueError, TypeError, InvalidId):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if values[0] != since:
+        raise HTTPException(status_code=400, detail="Cursor was issued for a different since")
+    return values[1], values[2], last
+
+async def record_tombstones(name, ids, seq, session=None):
+    if not ids:
+        return
+    deleted_at = datetime.now().isoformat()
+    await db.tombstones.insert_many(
+        [{"collection": name, "id": doc_id, "updated_seq": seq, "deleted_at": deleted_at} for doc_id in ids],
+        ordered=False,
+        session=session,
+    )
+
+# Stock adjustments. Site-log writes send all of their stock changes as one
+# bulk_write of $inc operations: a single round trip, and concurrent logs for
+# the same material can no longer overwrite each other's updates.
+def stock_deltas(old_log=None, new_log=None):
+    """Return {material_id: change in current_stock} for replacing old_log with new_log."""
+    deltas = {}
+    for log, sign in ((old_log, 1), (new_log, -1)):
+        if log:
+            for material_used in log['materials_used']:
+                material_id = material_used['material_id']
+                deltas[material_id] = deltas.get(material_id, 0) + sign * material_used['quantity']
+    return {material_id: delta for material_id, delta in deltas.items() if delta}
+
+async def apply_stock_deltas(deltas, seq, session=None):
+    if not deltas:
+        return
+    await db.materials.bulk_write(
+        [UpdateOne({"material_id": material_id}, {"$inc": {"current_stock": delta}, "$set": {"updated_seq": seq}})
+         for material_id, delta in deltas.items()],
+        ordered=False,
+        session=session,
+    )
+
+# Stock movement ledger. Every change to a material's stock is also appended
+# to stock_movements, dated by the log it came from. stock_snapshots holds
+# compacted end-of-day balances, so stock on a past date is one snapshot
+# plus the movements after it. A material's opening movement is kept on or
+# before its earliest other movement, so a backdated log moves it back.
+def log_stock_movements(old_log=None, new_log=None):
+    movements = []
+    for log, sign, reason in ((old_log, 1, "site_log_reversal"), (new_log, -1, "site_log")):
+        if log:
+            for material_used in log['materials_used']:
+                movements.append(StockMovement(
+                    material_id=material_used['material_id'],
+                    date=log['log_date'],
+                    delta=sign * material_used['quantity'],
+                    reason=reason,
+                    log_id=log['log_id'],
+                    site_id=log['site_id'],
+                ).dict())
+    return movements
+
+async def record_stock_movements(movements, session=None):
+    if not movements:
+        return
+    await db.stock_movements.insert_many(movements, ordered=False, session=session)
+    # A backdated movement makes that material's later snapshots stale
+    earliest = {}
+    for movement in movements:
+        material_id = movement['material_id']
+        earliest[material_id] = min(earliest.get(material_id, movement['date']), movement['date'])
+    await db.stock_snapshots.delete_many(
+        {"$or": [{"material_id": material_id, "as_of": {"$gte": day}} for material_id, day in earliest.items()]},
+        session=session,
+    )
+    # The opening balance must come first, or stock before it would go negative
+    await db.stock_movements.bulk_write(
+        [UpdateOne(
+            {"material_id": material_id, "reason": "opening", "date": {"$gt": day}}, {"$set": {"date": day}}
+        ) for material_id, day in earliest.items()],
+        ordered=False,
+        session=session,
+    )
+
+async def sum_stock_movements(match):
+    totals = await db.stock_movements.aggregate([
+        {"$match": match},
+        {"$group": {"_id": None, "delta": {"$sum": "$delta"}}},
+    ]).to_list(length=1)
+    return totals[0]['delta'] if totals else 0
+
+async def stock_at(material_id, as_of):
+    """Return (stock at the end of `as_of`, date of the snapshot used or None)."""
+    snapshot = await db.stock_snapshots.find_one(
+        {"material_id": material_id, "as_of": {"$lte": as_of}}, sort=[("as_of", DESCENDING)]
+    )
+    match = {"material_id": material_id, "date": {"$lte": as_of}}
+    if snapshot:
+        match["date"]["$gt"] = snapshot['as_of']
+    stock = (snapshot['stock'] if snapshot else 0) + await sum_stock_movements(match)
+    return stock, snapshot['as_of'] if snapshot else None
+
+async def ensure_opening_movements():
+    """Give materials created before the ledger existed an opening balance.
+
+    The opening movement is dated on the material's creation day, or on its
+    earliest movement if that is before, and makes the ledger add up to the
+    material's current_stock.
+    """
+    opened = await db.stock_movements.distinct("material_id", {"reason": "opening"})
+    materials = await db.materials.find({"material_id": {"$nin": opened}}).to_list(length=None)
+    for material in materials:
+        recorded = await sum_stock_movements({"material_id": material['material_id']})
+        first = await db.stock_movements.find_one({"material_id": material['material_id']}, sort=[("date", ASCENDING)])
+        await record_stock_movements([StockMovement(
+            material_id=material['material_id'],
+            date=min(material['created_at'][:10], first['date']) if first else material['created_at'][:10],
+            delta=material['current_stock'] - recorded,
+            reason="opening",
+        ).dict()])
+    return len(materials)
+
+async def compact_stock_snapshots(as_of=None):
+    """Snapshot every material's stock at the end of `as_of` (default: yesterday).
+
+    Meant to run periodically, e.g. nightly via `python server.py compact-stock`.
+    Movements are kept for history; snapshots only bound how many of them a
+    point-in-time query has to add up.
+    """
+    as_of = as_of or (date.today() - timedelta(days=1)).isoformat()
+    opened = await ensure_opening_movements()
+    material_ids = await db.materials.distinct("material_id")
+    for material_id in material_ids:
+        stock, _ = await stock_at(material_id, as_of)
+        await db.stock_snapshots.replace_one(
+            {"material_id": material_id, "as_of": as_of},
+            {"material_id": material_id, "as_of": as_of, "stock": stock, "created_at": datetime.now().isoformat()},
+            upsert=True,
+        )
+    return {"as_of": as_of, "snapshots": len(material_ids), "opening_movements": opened}
+
+# Per-site cost rollups. One site_cost_rollups document per site holds its
+# running totals; every log/overhead write applies its delta with $inc so
+# the site report is a single indexed point read.
+ROLLUP_FIELDS = ("total_material_cost", "total_labour_cost", "total_overhead_cost", "logs_count", "overheads_count")
+
+def rollup_incs(old_log=None, new_log=None, old_overhead=None, new_overhead=None):
+    """Return {site_id: {field: delta}} for replacing old documents with new ones."""
+    incs = {}
+    def add(site_id, field, value):
+        inc = incs.setdefault(site_id, {})
+        inc[field] = inc.get(field, 0) + value
+    for log, sign in ((old_log, -1), (new_log, 1)):
+        if log:
+            add(log['site_id'], "total_material_cost", sign * log['total_material_cost'])
+            add(log['site_id'], "total_labour_cost", sign * log['total_labour_cost'])
+            add(log['site_id'], "logs_count", sign)
+    for overhead, sign in ((old_overhead, -1), (new_overhead, 1)):
+        if overhead:
+            add(overhead['site_id'], "total_overhead_cost", sign * overhead['amount'])
+            add(overhead['site_id'], "overheads_count", sign)
+    return incs
+
+async def apply_rollup_incs(incs, session=None):
+    if not incs:
+        return
+    await db.site_cost_rollups.bulk_write(
+        [UpdateOne({"site_id": site_id}, {"$inc": inc}, upsert=True) for site_id, inc in incs.items()],
+        ordered=False,
+        session=session,
+    )
+
+async def cost_totals_by_site(match):
+    """Sum log and overhead costs per site inside MongoDB.
+
+    Both $group pipelines run concurrently and return one document per site,
+    so nothing but the totals crosses the wire.
+    """
+    log_pipeline = [
+        {"$match": match},
+        {"$group": {
+            "_id": "$site_id",
+            "total_material_cost": {"$sum": "$total_material_cost"},
+            "total_labour_cost": {"$sum": "$total_labour_cost"},
+            "logs_count": {"$sum": 1},
+        }},
+    ]
+    overhead_pipeline = [
+        {"$match": match},
+        {"$group": {
+            "_id": "$site_id",
+            "total_overhead_cost": {"$sum": "$amount"},
+            "overheads_count": {"$sum": 1},
+        }},
+    ]
+    log_totals, overhead_totals = await asyncio.gather(
+        db.site_daily_logs.aggregate(log_pipeline).to_list(length=None),
+        db.overheads.aggregate(overhead_pipeline).to_list(length=None),
+    )
+    totals = {}
+    for row in log_totals + overhead_totals:
+        site_totals = totals.setdefault(row.pop('_id'), dict.fromkeys(ROLLUP_FIELDS, 0))
+        site_totals.update(row)
+    return totals
+
+async def site_cost_totals(site_id):
+    totals = await cost_totals_by_site({"site_id": site_id})
+    return totals.get(site_id, dict.fromkeys(ROLLUP_FIELDS, 0))
+
+def rollup_drifted(expected, actual):
+    # Same tolerance as costs_differ: totals summed in a different order
+    # differ in the last bits, which on a large site exceeds any fixed epsilon
+    if actual is None:
+        return True
+    return any(
+        not math.isclose(expected[field], actual.get(field, 0), rel_tol=1e-9, abs_tol=1e-6) for field in ROLLUP_FIELDS
+    )
+
+async def reconcile_site_cost_rollups(fix=True):
+    """Recompute every rollup from the raw logs and overheads and report drift.
+
+    With fix=False this only verifies. Writes that land while a rebuild is
+    running can be overwritten, so run it in a quiet period.
+    """
+    site_ids, totals, rollups = await asyncio.gather(
+        db.sites.distinct("site_id"),
+        cost_totals_by_site({}),
+        db.site_cost_rollups.find({}, {"_id": 0}).to_list(length=None),
+    )
+    rollups = {rollup['site_id']: rollup for rollup in rollups}
+
+    drift = []
+    for site_id in set(site_ids) | set(totals):
+        expected = totals.get(site_id, dict.fromkeys(ROLLUP_FIELDS, 0))
+        actual = rollups.get(site_id)
+        if rollup_drifted(expected, actual):
+            drift.append({"site_id": site_id, "expected": expected, "actual": actual})
+    orphans = [site_id for site_id in rollups if site_id not in site_ids and site_id not in totals]
+
+    if fix:
+        for entry in drift:
+            await db.site_cost_rollups.replace_one(
+                {"site_id": entry['site_id']}, {"site_id": entry['site_id'], **entry['expected']}, upsert=True
+            )
+        if orphans:
+            await db.site_cost_rollups.delete_many({"site_id": {"$in": orphans}})
+        if drift:
+            # Site reports and the dashboard read the rollups
+            await bump_versions({"sites"} | {f"site:{entry['site_id']}" for entry in drift})
+
+    return {"checked": len(set(site_ids) | set(totals)), "drift": drift, "orphans": orphans, "fixed": fix}
+
+# Daily cost facts. One daily_cost_facts row per (date, site, cost type,
+# category) holds the summed amount and the number of entries behind it:
+# cost_type "material" and "labour" rows come from site logs (category
+# None), "overhead" rows from overheads per category. Writers apply their
+# deltas with $inc like the rollups, so trend queries group a small table
+# instead of the raw logs. backfill-cost-facts rebuilds it from scratch.
+FACT_KEY_FIELDS = ("date", "site_id", "cost_type", "category")
+
+def fact_incs(old_log=None, new_log=None, old_overhead=None, new_overhead=None):
+    """Return {(date, site_id, cost_type, category): {"amount", "entries"}} deltas."""
+    incs = {}
+    def add(key, amount, entries):
+        inc = incs.setdefault(key, {"amount": 0, "entries": 0})
+        inc['amount'] += amount
+        inc['entries'] += entries
+    for log, sign in ((old_log, -1), (new_log, 1)):
+        if log:
+            if log['materials_used']:
+                add((log['log_date'], log['site_id'], "material", None), sign * log['total_material_cost'], sign)
+            if log['labours_used']:
+                add((log['log_date'], log['site_id'], "labour", None), sign * log['total_labour_cost'], sign)
+    for overhead, sign in ((old_overhead, -1), (new_overhead, 1)):
+        if overhead:
+            add((overhead['date'], overhead['site_id'], "overhead", overhead['category']), sign * overhead['amount'], sign)
+    return {key: inc for key, inc in incs.items() if inc['amount'] or inc['entries']}
+
+async def apply_fact_incs(incs, session=None):
+    if not incs:
+        return
+    await db.daily_cost_facts.bulk_write(
+        [UpdateOne(dict(zip(FACT_KEY_FIELDS, key)), {"$inc": inc}, upsert=True) for key, inc in incs.items()],
+        ordered=False,
+        session=session,
+    )
+
+async def backfill_daily_cost_facts():
+    """Rebuild daily_cost_facts from the raw logs and overheads.
+
+    Like the rollup rebuild, writes that land while it runs can be lost, so
+    run it in a quiet period.
+    """
+    log_facts, overhead_facts = await asyncio.gather(
+        db.site_daily_logs.aggregate([
+            {"$group": {
+                "_id": {"date": "$log_date", "site_id": "$site_id"},
+                "material_amount": {"$sum": "$total_material_cost"},
+                "material_entries": {"$sum": {"$cond": [{"$gt": [{"$size": "$materials_used"}, 0]}, 1, 0]}},
+                "labour_amount": {"$sum": "$total_labour_cost"},
+                "labour_entries": {"$sum": {"$cond": [{"$gt": [{"$size": "$labours_used"}, 0]}, 1, 0]}},
+            }},
+        ]).to_list(length=None),
+        db.overheads.aggregate([
+            {"$group": {
+                "_id": {"date": "$date", "site_id": "$site_id", "category": "$category"},
+                "amount": {"$sum": "$amount"},
+                "entries": {"$sum": 1},
+            }},
+        ]).to_list(length=None),
+    )
+    facts = [
+        {"date": row['_id']['date'], "site_id": row['_id']['site_id'], "cost_type": cost_type,
+         "category": None, "amount": row[f"{cost_type}_amount"], "entries": row[f"{cost_type}_entries"]}
+        for row in log_facts
+        for cost_type in ("material", "labour")
+        if row[f"{cost_type}_entries"]
+    ] + [
+        {"date": row['_id']['date'], "site_id": row['_id']['site_id'], "cost_type": "overhead",
+         "category": row['_id']['category'], "amount": row['amount'], "entries": row['entries']}
+        for row in overhead_facts
+    ]
+    await db.daily_cost_facts.delete_many({})
+    for offset in range(0, len(facts), BULK_CHUNK_SIZE):
+        await db.daily_cost_facts.insert_many(facts[offset:offset + BULK_CHUNK_SIZE], ordered=False)
+    await bump_versions({"cost_facts"})
+    return {"facts": len(facts)}
+
+# Cost engine. A line costs quantity x rate_per_unit (materials) or count x
+# rate_per_day (labour) and a log's totals are the sums of its lines.
+# recost_logs re-derives both for many logs at once, to find and fix stored
+# costs that drifted or to charge a new rate from some date on. Each batch of
+# logs is flattened into NumPy columns with one entry per line item, so the
+# products, the comparison with the stored costs and the per-log sums are
+# array operations.
+COST_LINE_FIELDS = {
+    # kind: (list field, item id, quantity, rate)
+    "material": ("materials_used", "material_id", "quantity", "rate_per_unit"),
+    "labour": ("labours_used", "labour_id", "count", "rate_per_day"),
+}
+COST_BATCH_SIZE = 1000
+COST_SCAN_SORT = [("log_date", ASCENDING), ("_id", ASCENDING)]
+COST_SAMPLE_LIMIT = 100
+
+def costs_differ(expected, actual):
+    return ~np.isclose(expected, actual, rtol=1e-9, atol=1e-6)
+
+def cost_lines(logs, kind):
+    """Flatten one kind of line item from a batch of logs into columns."""
+    field, id_key, quantity_key, rate_key = COST_LINE_FIELDS[kind]
+    lines = [(position, line) for position, log in enumerate(logs) for line in log[field]]
+    count = len(lines)
+    return {
+        "log": np.fromiter((position for position, _ in lines), dtype=np.int64, count=count),
+        "line": [line for _, line in lines],
+        "item_id": np.array([line[id_key] for _, line in lines], dtype=object),
+        "quantity": np.fromiter((line[quantity_key] for _, line in lines), dtype=np.float64, count=count),
+        "rate": np.fromiter((line[rate_key] for _, line in lines), dtype=np.float64, count=count),
+        "total_cost": np.fromiter((line['total_cost'] for _, line in lines), dtype=np.float64, count=count),
+    }
+
+def recost_batch(logs, reprice=None):
+    """Re-derive the line costs and totals of a batch of logs.
+
+    reprice is an optional (kind, item_id, (dates, rates)) rate table;
+    matching lines are charged the rate in effect on their log date. Returns
+    {kind: (columns, new rates, new costs, changed line positions)}, {total
+    field: expected per-log totals} and a mask of the logs whose lines or
+    totals change.
+    """
+    lines = {}
+    totals = {}
+    changed_logs = np.zeros(len(logs), dtype=bool)
+    log_dates = np.array([log['log_date'] for log in logs], dtype=str)
+    for kind in COST_LINE_FIELDS:
+        columns = cost_lines(logs, kind)
+        rate = columns['rate']
+        if reprice and reprice[0] == kind and reprice[2][0]:
+            _, item_id, (dates, rates) = reprice
+            # Vectorized bisect: the last effective date on or before each line's log date
+            positions = np.searchsorted(np.array(dates, dtype=str), log_dates[columns['log']], side="right") - 1
+            matches = (columns['item_id'] == item_id) & (positions >= 0)
+            rate = np.where(matches, np.array(rates, dtype=np.float64)[positions], rate)
+        cost = columns['quantity'] * rate
+        changed = (rate != columns['rate']) | costs_differ(cost, columns['total_cost'])
+        changed_logs[columns['log'][changed]] = True
+        lines[kind] = (columns, rate, cost, np.flatnonzero(changed))
+        totals[f"total_{kind}_cost"] = np.bincount(columns['log'], weights=cost, minlength=len(logs))
+    totals['total_cost'] = totals['total_material_cost'] + totals['total_labour_cost']
+    for field, expected in totals.items():
+        stored = np.fromiter((log[field] for log in logs), dtype=np.float64, count=len(logs))
+        changed_logs |= costs_differ(expected, stored)
+    return lines, totals, changed_logs
+
+async def write_recosted_logs(logs, lines, totals, changed_logs, seq, session=None):
+    """Store new line costs and totals for the changed logs of a batch.
+
+    Returns the data-version scopes to bump once the batch has committed.
+    """
+    old_logs = {}
+    for position in np.flatnonzero(changed_logs):
+        log = logs[position]
+        old_logs[position] = {field: log[field] for field in (
+            "site_id", "log_date", "materials_used", "labours_used", "total_material_cost", "total_labour_cost"
+        )}
+    for kind, (columns, rate, cost, changed) in lines.items():
+        _, _, _, rate_key = COST_LINE_FIELDS[kind]
+        for i in changed:
+            line = columns['line'][i]
+            line[rate_key] = float(rate[i])
+            line['total_cost'] = float(cost[i])
+
+    updates, incs, facts = [], {}, {}
+    for position, old_log in old_logs.items():
+        log = logs[position]
+        for field, expected in totals.items():
+            log[field] = float(expected[position])
+        log['updated_seq'] = seq
+        updates.append(UpdateOne({"_id": log['_id']}, {"$set": {
+            field: log[field] for field in ("materials_used", "labours_used", "updated_seq", *totals)
+        }}))
+        add_deltas(incs, rollup_incs(old_log=old_log, new_log=log))
+        add_deltas(facts, fact_incs(old_log=old_log, new_log=log))
+    await db.site_daily_logs.bulk_write(updates, ordered=False, session=session)
+    await apply_rollup_incs(incs, session=session)
+    await apply_fact_incs(facts, session=session)
+    return {"site_logs"} | {f"site:{logs[position]['site_id']}" for position in old_logs}
+
+async def recost_logs(query=None, reprice=None, fix=False):
+    """Recompute the costs of the logs matching query, COST_BATCH_SIZE at a time.
+
+    With fix=False this only reports. Otherwise every log whose lines or
+    totals change is rewritten along with its rollup and cost fact updates,
+    one transaction per batch.
+    """
+    query = query or {}
+    summary = {"checked_logs": 0, "checked_lines": 0, "changed_logs": 0, "changed_lines": 0, "fixed": fix, "samples": []}
+    last = None
+    while True:
+        batch_query = {"$and": [query, keyset_filter(COST_SCAN_SORT, last)]} if last else query
+
+        async def run_batch(session, seq=None):
+            logs = await db.site_daily_logs.find(batch_query, session=session).sort(COST_SCAN_SORT).limit(
+                COST_BATCH_SIZE
+            ).to_list(length=None)
+            lines, totals, changed_logs = recost_batch(logs, reprice)
+            samples = [
+                {
+                    "log_id": logs[position]['log_id'],
+                    "site_id": logs[position]['site_id'],
+                    "log_date": logs[position]['log_date'],
+                    "expected": {field: float(expected[position]) for field, expected in totals.items()},
+                    "actual": {field: logs[position][field] for field in totals},
+                }
+                for position in np.flatnonzero(changed_logs)[:COST_SAMPLE_LIMIT - len(summary['samples'])]
+            ]
+            scopes = set()
+            if fix and changed_logs.any():
+                scopes = await write_recosted_logs(logs, lines, totals, changed_logs, seq, session=session)
+            return logs, lines, changed_logs, samples, scopes
+
+        logs, lines, changed_logs, samples, scopes = await (run_in_transaction(run_batch) if fix else run_batch(None))
+        await bump_versions(scopes)
+        if not logs:
+            break
+        summary['checked_logs'] += len(logs)
+        summary['checked_lines'] += sum(len(columns['line']) for columns, *_ in lines.values())
+        summary['changed_logs'] += int(changed_logs.sum())
+        summary['changed_lines'] += sum(len(changed) for *_, changed in lines.values())
+        summary['samples'].extend(samples)
+        last = [logs[-1]['log_date'], logs[-1]['_id']]
+    return summary
+
+# Rate history. rate_history holds every rate a material or labourer has had,
+# one row per (kind, item_id, effective_from); a rate applies from its date
+# until the next row's. Each item starts with an opening row dated RATE_EPOCH.
+# Every API process keeps the table in memory as sorted date lists, so
+# rate_at() is a bisect, and reloads it when the "rates" data version moves.
+RATE_EPOCH = "0001-01-01"
+RATE_CATALOGS = {
+    # kind: (catalog collection, catalog rate field)
+    "material": ("materials", "rate_per_unit"),
+    "labour": ("labours", "rate_per_day"),
+}
+RATE_SORT = [("kind", ASCENDING), ("item_id", ASCENDING), ("effective_from", ASCENDING)]
+
+class RateIndex:
+    """Effective-dated rates per (kind, item_id), looked up by date."""
+
+    def __init__(self):
+        self.tables = {}
+        self.version = None
+        self.lock = asyncio.Lock()
+
+    async def refresh(self):
+        """Reload the table if any rate was written since the last load."""
+        version = await data_version("rates")
+        if version == self.version:
+            return
+        async with self.lock:
+            if version == self.version:
+                return
+            rows = await db.rate_history.find(
+                {}, {"_id": 0, "kind": 1, "item_id": 1, "effective_from": 1, "rate": 1}
+            ).sort(RATE_SORT).to_list(length=None)
+            tables = {}
+            for row in rows:
+                dates, rates = tables.setdefault((row['kind'], row['item_id']), ([], []))
+                dates.append(row['effective_from'])
+                rates.append(row['rate'])
+            self.tables = tables
+            self.version = version
+
+    def table(self, kind, item_id):
+        """(sorted effective dates, rates) for one item"""
+        return self.tables.get((kind, item_id), ([], []))
+
+    def rate_at(self, kind, item_id, day):
+        dates, rates = self.table(kind, item_id)
+        position = bisect_right(dates, day) - 1
+        return rates[position] if position >= 0 else None
+
+rate_index = RateIndex()
+
+def rate_key(kind, item_id, effective_from):
+    return {"kind": kind, "item_id": item_id, "effective_from": effective_from}
+
+async def record_opening_rates(kind, items, session=None):
+    """Give new catalog items an opening rate_history row with their rate."""
+    if not items:
+        return
+    _, rate_field = RATE_CATALOGS[kind]
+    id_field = COST_LINE_FIELDS[kind][1]
+    await db.rate_history.bulk_write(
+        [UpdateOne(
+            rate_key(kind, item[id_field], RATE_EPOCH),
+            {"$setOnInsert": {"rate": item[rate_field], "created_at": datetime.now().isoformat()}},
+            upsert=True,
+        ) for item in items],
+        ordered=False,
+        session=session,
+    )
+
+async def ensure_opening_rates():
+    """Give materials and labourers created before rate_history existed an opening row."""
+    opened = 0
+    for kind, (collection, _) in RATE_CATALOGS.items():
+        id_field = COST_LINE_FIELDS[kind][1]
+        known = await db.rate_history.distinct("item_id", {"kind": kind})
+        items = await db[collection].find({id_field: {"$nin": known}}).to_list(length=None)
+        await record_opening_rates(kind, items)
+        opened += len(items)
+    if opened:
+        await bump_versions({"rates"})
+    return opened
+
+def rate_changes(table, from_date, rate, to_date=None):
+    """Rows to upsert and delete so that `rate` applies from from_date through to_date.
+
+    Without to_date the rate applies from from_date on. Also returns the
+    resulting (dates, rates) table.
+    """
+    dates, rates = table
+    upserts = {from_date: rate}
+    if to_date:
+        following = (date.fromisoformat(to_date) + timedelta(days=1)).isoformat()
+        position = bisect_right(dates, following) - 1
+        if position >= 0 and dates[position] != following:
+            upserts[following] = rates[position]
+    removed = [day for day in dates if day > from_date and (not to_date or day <= to_date)]
+    merged = {day: day_rate for day, day_rate in zip(dates, rates) if day not in removed}
+    merged.update(upserts)
+    return upserts, removed, (sorted(merged), [merged[day] for day in sorted(merged)])
+
+async def write_rate_changes(kind, item_id, upserts, removed, session=None):
+    now = datetime.now().isoformat()
+    await db.rate_history.bulk_write(
+        [DeleteOne(rate_key(kind, item_id, day)) for day in removed] + [
+            UpdateOne(rate_key(kind, item_id, day), {"$set": {"rate": rate}, "$setOnInsert": {"created_at": now}}, upsert=True)
+            for day, rate in upserts.items()
+        ],
+        session=session,
+    )
+
+async def get_rate_history(kind, item_id, as_of=None):
+    await rate_index.refresh()
+    dates, rates = rate_index.table(kind, item_id)
+    as_of = parse_day(as_of, "as_of") or date.today().isoformat()
+    return {
+        COST_LINE_FIELDS[kind][1]: item_id,
+        "rates": [{"effective_from": day, "rate": rate} for day, rate in zip(dates, rates)],
+        "as_of": as_of,
+        "rate": rate_index.rate_at(kind, item_id, as_of),
+    }
+
+async def reprice_logs(kind, item_id, reprice):
+    """Set an item's rate from from_date (through to_date) and recost its logs.
+
+    The new rate goes into rate_history, the catalog rate follows today's
+    rate, and every logged line for the item in the range is recharged at the
+    rate in effect on its log date. dry_run reports without writing.
+    """
+    collection, rate_field = RATE_CATALOGS[kind]
+    field, id_field, _, _ = COST_LINE_FIELDS[kind]
+    from_date = parse_day(reprice.from_date, "from")
+    to_date = parse_day(reprice.to_date, "to")
+    if to_date and to_date < from_date:
+        raise HTTPException(status_code=400, detail="to_date is before from_date")
+    item = await db[collection].find_one({id_field: item_id})
+    if not item:
+        raise HTTPException(status_code=404, detail=f"{kind.capitalize()} not found")
+
+    await rate_index.refresh()
+    table = rate_index.table(kind, item_id)
+    if not table[0]:
+        table = ([RATE_EPOCH], [item[rate_field]])
+    upserts, removed, table = rate_changes(table, from_date, reprice.rate, to_date)
+    if not reprice.dry_run:
+        today_rate = table[1][bisect_right(table[0], date.today().isoformat()) - 1]
+
+        async def write(session, seq):
+            await record_opening_rates(kind, [item], session=session)
+            await write_rate_changes(kind, item_id, upserts, removed, session=session)
+            if today_rate == item[rate_field]:
+                return {"rates"}
+            await db[collection].update_one(
+                {id_field: item_id},
+                {"$set": {rate_field: today_rate, "updated_seq": seq}},
+                session=session,
+            )
+            return {"rates", collection}
+
+        await bump_versions(await run_in_transaction(write))
+
+    query = {f"{field}.{id_field}": item_id, "log_date": day_range(from_date, to_date)}
+    summary = await recost_logs(query, reprice=(kind, item_id, table), fix=not reprice.dry_run)
+    return {**summary, "rates": [{"effective_from": day, "rate": rate} for day, rate in zip(*table)]}
+
+# Bulk import. Rows arrive as a JSON array or as NDJSON (read line by line
+# from the request stream) and are validated and inserted in chunks with
+# insert_many(ordered=False). Each chunk's side effects (stock, ledger,
+# rollups) are combined into one write per collection. Bad rows are reported
+# by index instead of failing the whole request.
+BULK_CHUNK_SIZE = 1000
+
+async def iter_ndjson_lines(request):
+    buffer = b""
+    async for data in request.stream():
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line
+    yield buffer
+
+async def iter_bulk_rows(request):
+    """Yield (index, row, parse_error) for every row in the request body."""
+    if NDJSON_MEDIA_TYPE in request.headers.get("content-type", ""):
+        index = 0
+        async for line in iter_ndjson_lines(request):
+            if not line.strip():
+                continue
+            try:
+                yield index, json.loads(line), None
+            except ValueError as e:
+                yield index, None, f"Invalid JSON: {e}"
+            index += 1
+        return
+
+    try:
+        rows = json.loads(await request.body())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body must be a JSON array or NDJSON")
+    if not isinstance(rows, list):
+        raise HTTPException(status_code=400, detail="Body must be a JSON array or NDJSON")
+    for index, row in enumerate(rows):
+        yield index, row, None
+
+async def iter_bulk_chunks(request):
+    chunk = []
+    async for item in iter_bulk_rows(request):
+        chunk.append(item)
+        if len(chunk) >= BULK_CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def validation_message(error):
+    return "; ".join(f"{'.'.join(str(part) for part in e['loc'])}: {e['msg']}" for e in error.errors())
+
+async def bulk_import(request, model, collection, prepare=None, after_insert=None):
+    """Validate and insert rows chunk by chunk.
+
+    `prepare(doc)` fills derived fields before insert and may reject the row
+    with a ValueError; `after_insert(docs)`
+    applies the side effects of the rows that were actually inserted. Each
+    chunk shares one updated_seq.
+    """
+    inserted = 0
+    errors = []
+    async for chunk in iter_bulk_chunks(request):
+        docs = []
+        indexes = []
+        for index, row, parse_error in chunk:
+            if parse_error:
+                errors.append({"index": index, "error": parse_error})
+                continue
+            try:
+                doc = model.model_validate(row).dict()
+                if prepare:
+                    doc = prepare(doc)
+            except ValidationError as e:
+                errors.append({"index": index, "error": validation_message(e)})
+                continue
+            except ValueError as e:
+                errors.append({"index": index, "error": str(e)})
+                continue
+            docs.append(doc)
+            indexes.append(index)
+        if not docs:
+            continue
+        async with reserve_seq() as seq:
+            for doc in docs:
+                doc['updated_seq'] = seq
+
+            failed = set()
+            try:
+                await collection.insert_many(docs, ordered=False)
+            except BulkWriteError as e:
+                for write_error in e.details['writeErrors']:
+                    failed.add(write_error['index'])
+                    errors.append({"index": indexes[write_error['index']], "error": write_error['errmsg']})
+            docs = [doc for position, doc in enumerate(docs) if position not in failed]
+            inserted += len(docs)
+            if docs and after_insert:
+                await after_insert(docs)
+
+    errors.sort(key=lambda error: error['index'])
+    return {"inserted": inserted, "failed": len(errors), "errors": errors}
+
 # SITES ROUTES
 @app.get("/api/sites", response_model=List[Site])
-async def get_sites():
-    sites = await db.sites.find().to_list(length=None)
-    return [serialize_doc(site) for site in sites]
+async def get_sites(
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    fields: Optional[str] = None,
+):
+    await check_etag(request, response, {"sites"})
+    return await paginate(response, db.sites, {}, SITE_SORT, Site, limit, after, fields)
 
 @app.post("/api/sites", response_model=Site)
 async def create_site(site: Site):
     site_dict = site.dict()
-    await db.sites.insert_one(site_dict)
+
+    async def write(session, seq):
+        site_dict['updated_seq'] = seq
+        await db.sites.insert_one(site_dict, session=session)
+        await db.site_cost_rollups.update_one(
+            {"site_id": site_dict['site_id']},
+            {"$setOnInsert": dict.fromkeys(ROLLUP_FIELDS, 0)},
+            upsert=True,
+            session=session,
+        )
+        return {"sites", f"site:{site_dict['site_id']}"}
+
+    await bump_versions(await run_in_transaction(write))
     return serialize_doc(site_dict)
 
 @app.put("/api/sites/{site_id}", response_model=Site)
 async def update_site(site_id: str, site: Site):
     site_dict = site.dict()
     site_dict['site_id'] = site_id
-    result = await db.sites.replace_one({"site_id": site_id}, site_dict)
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Site not found")
+
+    async def write(session, seq):
+        site_dict['updated_seq'] = seq
+        result = await db.sites.replace_one({"site_id": site_id}, site_dict, session=session)
+        if result.matched_count == 0:
+            raise HTTPException(status_code=404, detail="Site not found")
+        return {"sites", f"site:{site_id}"}
+
+    await bump_versions(await run_in_transaction(write))
     return serialize_doc(site_dict)
 
 @app.delete("/api/sites/{site_id}")
 async def delete_site(site_id: str):
-    result = await db.sites.delete_one({"site_id": site_id})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Site not found")
-    # Also delete related logs and overheads
-    await db.site_daily_logs.delete_many({"site_id": site_id})
-    await db.overheads.delete_many({"site_id": site_id})
+    async def write(session, seq):
+        result = await db.sites.delete_one({"site_id": site_id}, session=session)
+        if result.deleted_count == 0:
+            raise HTTPException(status_code=404, detail="Site not found")
+        # Also delete related logs and overheads
+        log_ids, overhead_ids = await asyncio.gather(
+            db.site_daily_logs.distinct("log_id", {"site_id": site_id}, session=session),
+            db.overheads.distinct("overhead_id", {"site_id": site_id}, session=session),
+        )
+        await db.site_daily_logs.delete_many({"site_id": site_id}, session=session)
+        await db.overheads.delete_many({"site_id": site_id}, session=session)
+        await db.site_cost_rollups.delete_one({"site_id": site_id}, session=session)
+        await db.daily_cost_facts.delete_many({"site_id": site_id}, session=session)
+        await record_tombstones("sites", [site_id], seq, session=session)
+        await record_tombstones("site_logs", log_ids, seq, session=session)
+        await record_tombstones("overheads", overhead_ids, seq, session=session)
+        return {"sites", "site_logs", "overheads", f"site:{site_id}"}
+
+    await bump_versions(await run_in_transaction(write))
     return {"message": "Site deleted successfully"}
 
 # MATERIALS ROUTES
 @app.get("/api/materials", response_model=List[Material])
-async def get_materials():
-    materials = await db.materials.find().to_list(length=None)
-    return [serialize_doc(material) for material in materials]
+async def get_materials(
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    fields: Optional[str] = None,
+):
+    versions = await check_etag(request, response, {"materials"})
+    return await paginate(
+        response, db.materials, {}, MATERIAL_SORT, Material, limit, after, fields, reference_cache, versions["materials"]
+    )
 
 @app.post("/api/materials", response_model=Material)
 async def create_material(material: Material):
     material_dict = material.dict()
-    await db.materials.insert_one(material_dict)
+
+    async def write(session, seq):
+        material_dict['updated_seq'] = seq
+        await db.materials.insert_one(material_dict, session=session)
+        await record_stock_movements([StockMovement(
+            material_id=material_dict['material_id'],
+            date=date.today().isoformat(),
+            delta=material_dict['current_stock'],
+            reason="opening",
+        ).dict()], session=session)
+        await record_opening_rates("material", [material_dict], session=session)
+        return {"materials", "rates"}
+
+    await bump_versions(await run_in_transaction(write))
     return serialize_doc(material_dict)
 
+@app.post("/api/materials/bulk")
+async def bulk_create_materials(request: Request):
+    async def after_insert(materials):
+        await record_stock_movements([StockMovement(
+            material_id=material['material_id'],
+            date=date.today().isoformat(),
+            delta=material['current_stock'],
+            reason="opening",
+        ).dict() for material in materials])
+        await record_opening_rates("material", materials)
+        await bump_versions({"materials", "rates"})
+
+    return await bulk_import(request, Material, db.materials, after_insert=after_insert)
+
 @app.put("/api/materials/{material_id}", response_model=Material)
 async def update_material(material_id: str, material: Material):
     material_dict = material.dict()
     material_dict['material_id'] = material_id
-    result = await db.materials.replace_one({"material_id": material_id}, material_dict)
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Material not found")
+
+    async def write(session, seq):
+        material_dict['updated_seq'] = seq
+        old_material = await db.materials.find_one_and_replace(
+            {"material_id": material_id}, material_dict, session=session
+        )
+        if not old_material:
+            raise HTTPException(status_code=404, detail="Material not found")
+        if material_dict['current_stock'] != old_material['current_stock']:
+            await record_stock_movements([StockMovement(
+                material_id=material_id,
+                date=date.today().isoformat(),
+                delta=material_dict['current_stock'] - old_material['current_stock'],
+                reason="adjustment",
+            ).dict()], session=session)
+        if material_dict['rate_per_unit'] != old_material['rate_per_unit']:
+            # The new rate applies from today; earlier logs keep the old one
+            await record_opening_rates("material", [old_material], session=session)
+            await write_rate_changes(
+                "material", material_id, {date.today().isoformat(): material_dict['rate_per_unit']}, [], session=session
+            )
+            return {"materials", "rates"}
+        return {"materials"}
+
+    await bump_versions(await run_in_transaction(write))
     return serialize_doc(material_dict)
 
 @app.delete("/api/materials/{material_id}")
 async def delete_material(material_id: str):
-    result = await db.materials.delete_one({"material_id": material_id})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Material not found")
+    async def write(session, seq):
+        result = await db.materials.delete_one({"material_id": material_id}, session=session)
+        if result.deleted_count == 0:
+            raise HTTPException(status_code=404, detail="Material not found")
+        await record_tombstones("materials", [material_id], seq, session=session)
+        return {"materials"}
+
+    await bump_versions(await run_in_transaction(write))
     return {"message": "Material deleted successfully"}
 
+@app.get("/api/materials/{material_id}/rates")
+async def get_material_rates(material_id: str, as_of: Optional[str] = None):
+    """Effective-dated rate_per_unit history and the rate on `as_of` (default today)."""
+    return await get_rate_history("material", material_id, as_of)
+
+@app.post("/api/materials/{material_id}/reprice")
+async def reprice_material(material_id: str, reprice: RepriceRequest):
+    """Charge a new rate_per_unit from from_date (to to_date) and recost the logs."""
+    return await reprice_logs("material", material_id, reprice)
+
+@app.get("/api/materials/{material_id}/stock")
+async def get_material_stock_at(material_id: str, as_of: Optional[str] = None):
+    """Stock at the end of `as_of` (YYYY-MM-DD, default today) from the movement ledger."""
+    as_of = as_of or date.today().isoformat()
+    stock, snapshot_as_of = await stock_at(material_id, as_of)
+    return {"material_id": material_id, "as_of": as_of, "stock": stock, "snapshot_as_of": snapshot_as_of}
+
+@app.get("/api/materials/{material_id}/movements", response_model=List[StockMovement])
+async def get_material_movements(
+    material_id: str,
+    response: Response,
+    from_date: Optional[str] = Query(None, alias="from"),
+    to_date: Optional[str] = Query(None, alias="to"),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    fields: Optional[str] = None,
+):
+    query = {"material_id": material_id}
+    if from_date or to_date:
+        query["date"] = day_range(from_date, to_date)
+    return await paginate(response, db.stock_movements, query, STOCK_MOVEMENT_SORT, StockMovement, limit, after, fields)
+
 # LABOURS ROUTES
 @app.get("/api/labours", response_model=List[Labour])
-async def get_labours():
-    labours = await db.labours.find().to_list(length=None)
-    return [serialize_doc(labour) for labour in labours]
+async def get_labours(
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    fields: Optional[str] = None,
+):
+    versions = await check_etag(request, response, {"labours"})
+    return await paginate(
+        response, db.labours, {}, LABOUR_SORT, Labour, limit, after, fields, reference_cache, versions["labours"]
+    )
 
 @app.post("/api/labours", response_model=Labour)
 async def create_labour(labour: Labour):
     labour_dict = labour.dict()
-    await db.labours.insert_one(labour_dict)
+
+    async def write(session, seq):
+        labour_dict['updated_seq'] = seq
+        await db.labours.insert_one(labour_dict, session=session)
+        await record_opening_rates("labour", [labour_dict], session=session)
+        return {"labours", "rates"}
+
+    await bump_versions(await run_in_transaction(write))
     return serialize_doc(labour_dict)
 
+@app.post("/api/labours/bulk")
+async def bulk_create_labours(request: Request):
+    async def after_insert(labours):
+        await record_opening_rates("labour", labours)
+        await bump_versions({"labours", "rates"})
+
+    return await bulk_import(request, Labour, db.labours, after_insert=after_insert)
+
 @app.put("/api/labours/{labour_id}", response_model=Labour)
 async def update_labour(labour_id: str, labour: Labour):
     labour_dict = labour.dict()
     labour_dict['labour_id'] = labour_id
-    result = await db.labours.replace_one({"labour_id": labour_id}, labour_dict)
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Labour not found")
+
+    async def write(session, seq):
+        labour_dict['updated_seq'] = seq
+        old_labour = await db.labours.find_one_and_replace({"labour_id": labour_id}, labour_dict, session=session)
+        if not old_labour:
+            raise HTTPException(status_code=404, detail="Labour not found")
+        if labour_dict['rate_per_day'] != old_labour['rate_per_day']:
+            # The new rate applies from today; earlier logs keep the old one
+            await record_opening_rates("labour", [old_labour], session=session)
+            await write_rate_changes(
+                "labour", labour_id, {date.today().isoformat(): labour_dict['rate_per_day']}, [], session=session
+            )
+            return {"labours", "rates"}
+        return {"labours"}
+
+    await bump_versions(await run_in_transaction(write))
     return serialize_doc(labour_dict)
 
 @app.delete("/api/labours/{labour_id}")
 async def delete_labour(labour_id: str):
-    result = await db.labours.delete_one({"labour_id": labour_id})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Labour not found")
+    async def write(session, seq):
+        result = await db.labours.delete_one({"labour_id": labour_id}, session=session)
+        if result.deleted_count == 0:
+            raise HTTPException(status_code=404, detail="Labour not found")
+        await record_tombstones("labours", [labour_id], seq, session=session)
+        return {"labours"}
+
+    await bump_versions(await run_in_transaction(write))
     return {"message": "Labour deleted successfully"}
 
+@app.get("/api/labours/{labour_id}/rates")
+async def get_labour_rates(labour_id: str, as_of: Optional[str] = None):
+    """Effective-dated rate_per_day history and the rate on `as_of` (default today)."""
+    return await get_rate_history("labour", labour_id, as_of)
+
+@app.post("/api/labours/{labour_id}/reprice")
+async def reprice_labour(labour_id: str, reprice: RepriceRequest):
+    """Charge a new rate_per_day from from_date (to to_date) and recost the logs."""
+    return await reprice_logs("labour", labour_id, reprice)
+
 # SITE DAILY LOGS ROUTES
 @app.get("/api/site-logs", response_model=List[SiteDailyLog])
-async def get_site_logs(site_id: Optional[str] = None):
+async def get_site_logs(
+    request: Request,
+    response: Response,
+    site_id: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    fields: Optional[str] = None,
+    stream: bool = False,
+):
     query = {"site_id": site_id} if site_id else {}
-    logs = await db.site_daily_logs.find(query).sort("log_date", -1).to_list(length=None)
-    return [serialize_doc(log) for log in logs]
+    if wants_ndjson(request, stream):
+        return stream_ndjson(db.site_daily_logs, query, SITE_LOG_SORT, SiteDailyLog, limit, after, fields)
+    await check_etag(request, response, {"site_logs"})
+    return await paginate(response, db.site_daily_logs, query, SITE_LOG_SORT, SiteDailyLog, limit, after, fields)
 
 @app.post("/api/site-logs", response_model=SiteDailyLog)
 async def create_site_log(log: SiteDailyLog):
     log_dict = log.dict()
     
-    # Calculate costs
-    material_cost = sum(m['total_cost'] for m in log_dict['materials_used'])
-    labour_cost = sum(l['total_cost'] for l in log_dict['labours_used'])
-    log_dict['total_material_cost'] = material_cost
-    log_dict['total_labour_cost'] = labour_cost
-    log_dict['total_cost'] = material_cost + labour_cost
+    await price_log(log_dict)
     
-    # Update central inventory - reduce stock
-    for material_used in log_dict['materials_used']:
-        material = await db.materials.find_one({"material_id": material_used['material_id']})
-        if material:
-            new_stock = material['current_stock'] - material_used['quantity']
-            await db.materials.update_one(
-                {"material_id": material_used['material_id']},
-                {"$set": {"current_stock": new_stock}}
-            )
-    
-    await db.site_daily_logs.insert_one(log_dict)
+    async def write(session, seq):
+        log_dict['updated_seq'] = seq
+        # Update central inventory - reduce stock
+        await apply_stock_deltas(stock_deltas(new_log=log_dict), log_dict['updated_seq'], session=session)
+        await record_stock_movements(log_stock_movements(new_log=log_dict), session=session)
+        await db.site_daily_logs.insert_one(log_dict, session=session)
+        await apply_rollup_incs(rollup_incs(new_log=log_dict), session=session)
+        await apply_fact_incs(fact_incs(new_log=log_dict), session=session)
+        return log_version_scopes(log_dict)
+
+    await bump_versions(await run_in_transaction(write))
     return serialize_doc(log_dict)
 
+@app.post("/api/site-logs/bulk")
+async def bulk_create_site_logs(request: Request):
+    async def after_insert(logs):
+        deltas = {}
+        incs = {}
+        facts = {}
+        movements = []
+        for log in logs:
+            add_deltas(deltas, stock_deltas(new_log=log))
+            add_deltas(incs, rollup_incs(new_log=log))
+            add_deltas(facts, fact_incs(new_log=log))
+            movements.extend(log_stock_movements(new_log=log))
+        await asyncio.gather(
+            apply_stock_deltas(deltas, logs[0]['updated_seq']),
+            record_stock_movements(movements),
+            apply_rollup_incs(incs),
+            apply_fact_incs(facts),
+        )
+        await bump_versions(log_version_scopes(*logs))
+
+    await rate_index.refresh()
+    return await bulk_import(request, SiteDailyLog, db.site_daily_logs, compute_log_totals, after_insert)
+
 @app.put("/api/site-logs/{log_id}", response_model=SiteDailyLog)
 async def update_site_log(log_id: str, log: SiteDailyLog):
-    # First, get the old log to restore stock
-    old_log = await db.site_daily_logs.find_one({"log_id": log_id})
-    if not old_log:
-        raise HTTPException(status_code=404, detail="Log not found")
-    
-    # Restore old stock
-    for material_used in old_log['materials_used']:
-        material = await db.materials.find_one({"material_id": material_used['material_id']})
-        if material:
-            new_stock = material['current_stock'] + material_used['quantity']
-            await db.materials.update_one(
-                {"material_id": material_used['material_id']},
-                {"$set": {"current_stock": new_stock}}
-            )
-    
     # Update with new data
     log_dict = log.dict()
     log_dict['log_id'] = log_id
     
-    # Calculate costs
-    material_cost = sum(m['total_cost'] for m in log_dict['materials_used'])
-    labour_cost = sum(l['total_cost'] for l in log_dict['labours_used'])
-    log_dict['total_material_cost'] = material_cost
-    log_dict['total_labour_cost'] = labour_cost
-    log_dict['total_cost'] = material_cost + labour_cost
+    await price_log(log_dict)
     
-    # Reduce stock for new materials
-    for material_used in log_dict['materials_used']:
-        material = await db.materials.find_one({"material_id": material_used['material_id']})
-        if material:
-            new_stock = material['current_stock'] - material_used['quantity']
-            await db.materials.update_one(
-                {"material_id": material_used['material_id']},
-                {"$set": {"current_stock": new_stock}}
-            )
-    
-    await db.site_daily_logs.replace_one({"log_id": log_id}, log_dict)
+    async def write(session, seq):
+        log_dict['updated_seq'] = seq
+        # Swap the log atomically and keep the old one to restore its stock
+        old_log = await db.site_daily_logs.find_one_and_replace({"log_id": log_id}, log_dict, session=session)
+        if not old_log:
+            raise HTTPException(status_code=404, detail="Log not found")
+        
+        # Restore old stock and reduce stock for new materials in one round trip
+        await apply_stock_deltas(stock_deltas(old_log=old_log, new_log=log_dict), log_dict['updated_seq'], session=session)
+        await record_stock_movements(log_stock_movements(old_log=old_log, new_log=log_dict), session=session)
+        await apply_rollup_incs(rollup_incs(old_log=old_log, new_log=log_dict), session=session)
+        await apply_fact_incs(fact_incs(old_log=old_log, new_log=log_dict), session=session)
+        return log_version_scopes(old_log, log_dict)
+
+    await bump_versions(await run_in_transaction(write))
     return serialize_doc(log_dict)
 
 @app.delete("/api/site-logs/{log_id}")
 async def delete_site_log(log_id: str):
-    log = await db.site_daily_logs.find_one({"log_id": log_id})
-    if not log:
-        raise HTTPException(status_code=404, detail="Log not found")
-    
-    # Restore stock
-    for material_used in log['materials_used']:
-        material = await db.materials.find_one({"material_id": material_used['material_id']})
-        if material:
-            new_stock = material['current_stock'] + material_used['quantity']
-            await db.materials.update_one(
-                {"material_id": material_used['material_id']},
-                {"$set": {"current_stock": new_stock}}
-            )
-    
-    await db.site_daily_logs.delete_one({"log_id": log_id})
+    async def write(session, seq):
+        # Only one of several concurrent deletes gets the document back
+        log = await db.site_daily_logs.find_one_and_delete({"log_id": log_id}, session=session)
+        if not log:
+            raise HTTPException(status_code=404, detail="Log not found")
+        
+        await record_tombstones("site_logs", [log_id], seq, session=session)
+        # Restore stock
+        await apply_stock_deltas(stock_deltas(old_log=log), seq, session=session)
+        await record_stock_movements(log_stock_movements(old_log=log), session=session)
+        await apply_rollup_incs(rollup_incs(old_log=log), session=session)
+        await apply_fact_incs(fact_incs(old_log=log), session=session)
+        return log_version_scopes(log)
+
+    await bump_versions(await run_in_transaction(write))
     return {"message": "Log deleted successfully"}
 
 # OVERHEADS ROUTES
 @app.get("/api/overheads", response_model=List[Overhead])
-async def get_overheads(site_id: Optional[str] = None):
+async def get_overheads(
+    request: Request,
+    response: Response,
+    site_id: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    fields: Optional[str] = None,
+    stream: bool = False,
+):
     query = {"site_id": site_id} if site_id else {}
-    overheads = await db.overheads.find(query).sort("date", -1).to_list(length=None)
-    return [serialize_doc(overhead) for overhead in overheads]
+    if wants_ndjson(request, stream):
+        return stream_ndjson(db.overheads, query, OVERHEAD_SORT, Overhead, limit, after, fields)
+    await check_etag(request, response, {"overheads"})
+    return await paginate(response, db.overheads, query, OVERHEAD_SORT, Overhead, limit, after, fields)
 
 @app.post("/api/overheads", response_model=Overhead)
 async def create_overhead(overhead: Overhead):
     overhead_dict = overhead.dict()
-    await db.overheads.insert_one(overhead_dict)
+
+    async def write(session, seq):
+        overhead_dict['updated_seq'] = seq
+        await db.overheads.insert_one(overhead_dict, session=session)
+        await apply_rollup_incs(rollup_incs(new_overhead=overhead_dict), session=session)
+        await apply_fact_incs(fact_incs(new_overhead=overhead_dict), session=session)
+        return overhead_version_scopes(overhead_dict)
+
+    await bump_versions(await run_in_transaction(write))
     return serialize_doc(overhead_dict)
 
+@app.post("/api/overheads/bulk")
+async def bulk_create_overheads(request: Request):
+    async def after_insert(overheads):
+        incs = {}
+        facts = {}
+        for overhead in overheads:
+            add_deltas(incs, rollup_incs(new_overhead=overhead))
+            add_deltas(facts, fact_incs(new_overhead=overhead))
+        await asyncio.gather(
+            apply_rollup_incs(incs),
+            apply_fact_incs(facts),
+        )
+        await bump_versions(overhead_version_scopes(*overheads))
+
+    return await bulk_import(request, Overhead, db.overheads, after_insert=after_insert)
+
 @app.put("/api/overheads/{overhead_id}", response_model=Overhead)
 async def update_overhead(overhead_id: str, overhead: Overhead):
     overhead_dict = overhead.dict()
     overhead_dict['overhead_id'] = overhead_id
-    result = await db.overheads.replace_one({"overhead_id": overhead_id}, overhead_dict)
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Overhead not found")
+
+    async def write(session, seq):
+        overhead_dict['updated_seq'] = seq
+        old_overhead = await db.overheads.find_one_and_replace(
+            {"overhead_id": overhead_id}, overhead_dict, session=session
+        )
+        if not old_overhead:
+            raise HTTPException(status_code=404, detail="Overhead not found")
+        await apply_rollup_incs(rollup_incs(old_overhead=old_overhead, new_overhead=overhead_dict), session=session)
+        await apply_fact_incs(fact_incs(old_overhead=old_overhead, new_overhead=overhead_dict), session=session)
+        return overhead_version_scopes(old_overhead, overhead_dict)
+
+    await bump_versions(await run_in_transaction(write))
     return serialize_doc(overhead_dict)
 
 @app.delete("/api/overheads/{overhead_id}")
 async def delete_overhead(overhead_id: str):
-    result = await db.overheads.delete_one({"overhead_id": overhead_id})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Overhead not found")
+    async def write(session, seq):
+        overhead = await db.overheads.find_one_and_delete({"overhead_id": overhead_id}, session=session)
+        if not overhead:
+            raise HTTPException(status_code=404, detail="Overhead not found")
+        await record_tombstones("overheads", [overhead_id], seq, session=session)
+        await apply_rollup_incs(rollup_incs(old_overhead=overhead), session=session)
+        await apply_fact_incs(fact_incs(old_overhead=overhead), session=session)
+        return overhead_version_scopes(overhead)
+
+    await bump_versions(await run_in_transaction(write))
     return {"message": "Overhead deleted successfully"}
 
+# DASHBOARD ROUTES
+BOOTSTRAP_RECENT = 50
+
+@app.get("/api/bootstrap")
+async def get_bootstrap(
+    request: Request,
+    response: Response,
+    recent: int = Query(BOOTSTRAP_RECENT, ge=1, le=MAX_PAGE_SIZE),
+):
+    """Everything the dashboard renders on load, in one round trip.
+
+    Sites, materials and labours are sent in full since the forms need them.
+    Logs and overheads are capped at the `recent` newest, with their totals
+    supplied as counts, and per-site costs come from the rollups. `seq` is
+    the starting point for /api/sync.
+    """
+    versions = await check_etag(request, response, {"sites", "materials", "labours", "site_logs", "overheads"})
+    # Read first: anything written while the queries run is sent again by sync
+    seq = await sync_watermark()
+    (sites, materials_page, labours_page, logs, overheads, rollups,
+     material_value, logs_count, overheads_count) = await asyncio.gather(
+        db.sites.find().sort(SITE_SORT).to_list(length=None),
+        fetch_page(db.materials, {}, MATERIAL_SORT, Material, cache=reference_cache, version=versions["materials"]),
+        fetch_page(db.labours, {}, LABOUR_SORT, Labour, cache=reference_cache, version=versions["labours"]),
+        db.site_daily_logs.find().sort(SITE_LOG_SORT).limit(recent).to_list(length=None),
+        db.overheads.find().sort(OVERHEAD_SORT).limit(recent).to_list(length=None),
+        db.site_cost_rollups.find({}, {"_id": 0}).to_list(length=None),
+        db.materials.aggregate([
+            {"$group": {"_id": None, "value": {"$sum": {"$multiply": ["$rate_per_unit", "$current_stock"]}}}},
+        ]).to_list(length=None),
+        db.site_daily_logs.estimated_document_count(),
+        db.overheads.estimated_document_count(),
+    )
+
+    site_totals = {rollup.pop('site_id'): rollup for rollup in rollups}
+    missing = [site['site_id'] for site in sites if site['site_id'] not in site_totals]
+    if missing:
+        # Sites that predate the rollups and no rebuild has run yet
+        computed = await cost_totals_by_site({"site_id": {"$in": missing}})
+        for site_id in missing:
+            site_totals[site_id] = computed.get(site_id, dict.fromkeys(ROLLUP_FIELDS, 0))
+    for totals in site_totals.values():
+        totals['grand_total'] = totals['total_material_cost'] + totals['total_labour_cost'] + totals['total_overhead_cost']
+
+    return {
+        "seq": seq,
+        "sites": [serialize_doc(site) for site in sites],
+        "materials": materials_page[1],
+        "labours": labours_page[1],
+        "recent_logs": [serialize_doc(log) for log in logs],
+        "recent_overheads": [serialize_doc(overhead) for overhead in overheads],
+        "logs_count": logs_count,
+        "overheads_count": overheads_count,
+        "total_material_value": material_value[0]['value'] if material_value else 0,
+        "site_totals": {site['site_id']: site_totals[site['site_id']] for site in sites},
+    }
+
+@app.get("/api/sync")
+async def sync_changes(
+    since: int = Query(0, ge=0),
+    limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+):
+    """Documents written and ids deleted after `since`, at most `limit` per page.
+
+    Clients apply `deleted` before `changes`. While `next` is set they fetch
+    it with after=<next> and the same `since`; after the last page they send
+    the returned `seq` as `since` next time. since=0 returns every document.
+    A `since` older than the pruned sync history gets 410: start again from
+    since=0.
+    """
+    if after:
+        seq, stream, last = decode_sync_cursor(after, since)
+    else:
+        if since and since < await pruned_seq():
+            raise HTTPException(status_code=410, detail="Sync history since this seq was pruned; sync from since=0")
+        # A client may already be past a write that has since started
+        seq, stream, last = max(since, await sync_watermark()), 0, None
+    window = {"updated_seq": {"$gt": since, "$lte": seq} if since else {"$lte": seq}}
+
+    # Tombstones first, then each collection, each in (updated_seq, _id) order
+    streams = [db.tombstones] + [db[collection] for collection in SYNC_COLLECTIONS.values()]
+    names = [None, *SYNC_COLLECTIONS]
+    changes = {name: [] for name in SYNC_COLLECTIONS}
+    deleted = {name: [] for name in SYNC_COLLECTIONS}
+    remaining, next_cursor = limit, None
+    for position in range(stream, len(streams)):
+        if position == 0 and not since:
+            continue  # a full copy has nothing to delete
+        if not remaining:
+            next_cursor = encode_sync_cursor(since, seq, position)
+            break
+        query = {"$and": [window, keyset_filter(SYNC_SORT, last)]} if last else window
+        docs = await streams[position].find(query).sort(SYNC_SORT).limit(remaining + 1).to_list(length=None)
+        last = None
+        if len(docs) > remaining:
+            docs = docs[:remaining]
+            next_cursor = encode_sync_cursor(since, seq, position, docs[-1])
+        if position == 0:
+            for tombstone in docs:
+                deleted[tombstone['collection']].append(tombstone['id'])
+        else:
+            changes[names[position]].extend(serialize_doc(doc) for doc in docs)
+        remaining -= len(docs)
+        if next_cursor:
+            break
+
+    logs_count, overheads_count = await asyncio.gather(
+        db.site_daily_logs.estimated_document_count(),
+        db.overheads.estimated_document_count(),
+    )
+    return {
+        "seq": seq,
+        "next": next_cursor,
+        "changes": changes,
+        "deleted": deleted,
+        "logs_count": logs_count,
+        "overheads_count": overheads_count,
+    }
+
 # REPORTS ROUTES
 @app.get("/api/reports/site/{site_id}")
-async def get_site_report(site_id: str):
-    site = await db.sites.find_one({"site_id": site_id})
+async def get_site_report(site_id: str, request: Request, response: Response):
+    await check_etag(request, response, {f"site:{site_id}"})
+    site, totals = await asyncio.gather(
+        db.sites.find_one({"site_id": site_id}),
+        db.site_cost_rollups.find_one({"site_id": site_id}),
+    )
     if not site:
         raise HTTPException(status_code=404, detail="Site not found")
+    if not totals:
+        # Site predates the rollups and no rebuild has run yet
+        totals = await site_cost_totals(site_id)
     
-    logs = await db.site_daily_logs.find({"site_id": site_id}).to_list(length=None)
-    overheads = await db.overheads.find({"site_id": site_id}).to_list(length=None)
-    
-    total_material_cost = sum(log['total_material_cost'] for log in logs)
-    total_labour_cost = sum(log['total_labour_cost'] for log in logs)
-    total_overhead_cost = sum(overhead['amount'] for overhead in overheads)
-    grand_total = total_material_cost + total_labour_cost + total_overhead_cost
+    grand_total = totals["total_material_cost"] + totals["total_labour_cost"] + totals["total_overhead_cost"]
     
     return {
         "site": serialize_doc(site),
-        "total_material_cost": total_material_cost,
-        "total_labour_cost": total_labour_cost,
-        "total_overhead_cost": total_overhead_cost,
+        "total_material_cost": totals["total_material_cost"],
+        "total_labour_cost": totals["total_labour_cost"],
+        "total_overhead_cost": totals["total_overhead_cost"],
         "grand_total": grand_total,
-        "logs_count": len(logs),
-        "overheads_count": len(overheads)
+        "logs_count": totals["logs_count"],
+        "overheads_count": totals["overheads_count"]
     }
 
+def date_bucket(field, period):
+    """Aggregation expression for the day, week or month of a YYYY-MM-DD field.
+
+    Dates are stored as strings, so a month is a prefix and a week is the ISO
+    year and week of the parsed date.
+    """
+    if period == "week":
+        return {"$dateToString": {
+            "format": "%G-W%V",
+            "date": {"$dateFromString": {"dateString": field, "format": "%Y-%m-%d"}},
+        }}
+    if period == "month":
+        return {"$substrBytes": [field, 0, 7]}
+    return field
+
+def parse_day(value, name):
+    if value is None:
+        return None
+    try:
+        return date.fromisoformat(value).isoformat()
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {name} date, expected YYYY-MM-DD")
+
+def parse_site_ids(site_ids):
+    """Comma-separated site ids, or None for all sites"""
+    return [site_id.strip() for site_id in site_ids.split(",") if site_id.strip()] if site_ids else None
+
+def day_range(from_date, to_date):
+    """Query condition for a YYYY-MM-DD field between two inclusive dates"""
+    condition = {}
+    if from_date:
+        condition["$gte"] = from_date
+    if to_date:
+        condition["$lte"] = to_date
+    return condition
+
 @app.get("/api/reports/daily")
-async def get_daily_report(date: Optional[str] = None):
-    query = {"log_date": date} if date else {}
-    logs = await db.site_daily_logs.find(query).to_list(length=None)
-    
-    total_cost = sum(log['total_cost'] for log in logs)
-    
+async def get_daily_report(
+    request: Request,
+    response: Response,
+    date: Optional[str] = None,
+    from_date: Optional[str] = Query(None, alias="from"),
+    to_date: Optional[str] = Query(None, alias="to"),
+    site_ids: Optional[str] = None,
+    group_by: Optional[Literal["day", "week", "month", "site"]] = None,
+):
+    """Logs for one date, a from/to range and/or a list of sites.
+
+    Without group_by the matching logs are returned as before. With it, the
+    totals are summed per bucket inside MongoDB and no logs are sent. Site
+    buckets carry the site's current name.
+    """
+    await check_etag(request, response, {"site_logs", "sites"} if group_by == "site" else {"site_logs"})
+    if date and (from_date or to_date):
+        raise HTTPException(status_code=400, detail="Use either date or from/to, not both")
+    from_date = parse_day(from_date, "from")
+    to_date = parse_day(to_date, "to")
+    sites = parse_site_ids(site_ids)
+
+    query = {}
+    if date:
+        query["log_date"] = date
+    elif from_date or to_date:
+        query["log_date"] = day_range(from_date, to_date)
+    if sites:
+        query["site_id"] = {"$in": sites}
+    filters = {"from": from_date, "to": to_date, "site_ids": sites}
+
+    if group_by is None:
+        logs = await db.site_daily_logs.find(query).to_list(length=None)
+        
+        total_cost = sum(log['total_cost'] for log in logs)
+        
+        return {
+            "date": date or "All dates",
+            **filters,
+            "logs": [serialize_doc(log) for log in logs],
+            "total_cost": total_cost
+        }
+
+    group = {
+        "_id": "$site_id" if group_by == "site" else date_bucket("$log_date", group_by),
+        "total_material_cost": {"$sum": "$total_material_cost"},
+        "total_labour_cost": {"$sum": "$total_labour_cost"},
+        "total_cost": {"$sum": "$total_cost"},
+        "logs_count": {"$sum": 1},
+    }
+    buckets = await db.site_daily_logs.aggregate([
+        {"$match": query},
+        {"$group": group},
+        {"$sort": {"_id": 1}},
+        {"$project": {"_id": 0, "key": "$_id", **{field: 1 for field in group if field != "_id"}}},
+    ]).to_list(length=None)
+    if group_by == "site":
+        # Logs keep the name the site had when they were written
+        names = {
+            site['site_id']: site['name']
+            for site in await db.sites.find(
+                {"site_id": {"$in": [bucket['key'] for bucket in buckets]}}, {"_id": 0, "site_id": 1, "name": 1}
+            ).to_list(length=None)
+        }
+        for bucket in buckets:
+            bucket['site_name'] = names.get(bucket['key'])
+
     return {
         "date": date or "All dates",
-        "logs": [serialize_doc(log) for log in logs],
-        "total_cost": total_cost
+        **filters,
+        "group_by": group_by,
+        "buckets": buckets,
+        "total_cost": sum(bucket['total_cost'] for bucket in buckets),
+    }
+
+@app.get("/api/reports/trends")
+async def get_cost_trends(
+    request: Request,
+    response: Response,
+    from_date: Optional[str] = Query(None, alias="from"),
+    to_date: Optional[str] = Query(None, alias="to"),
+    site_ids: Optional[str] = None,
+    group_by: Literal["day", "week", "month"] = "day",
+    per_site: bool = False,
+):
+    """Material, labour and overhead cost per period from daily_cost_facts."""
+    await check_etag(request, response, {"site_logs", "overheads", "cost_facts"})
+    from_date = parse_day(from_date, "from")
+    to_date = parse_day(to_date, "to")
+    sites = parse_site_ids(site_ids)
+
+    # Rows whose entries were all deleted stay behind with zero counts
+    query = {"entries": {"$gt": 0}}
+    if from_date or to_date:
+        query["date"] = day_range(from_date, to_date)
+    if sites:
+        query["site_id"] = {"$in": sites}
+    group_id = {"period": date_bucket("$date", group_by), "cost_type": "$cost_type", "category": "$category"}
+    if per_site:
+        group_id["site_id"] = "$site_id"
+    rows = await db.daily_cost_facts.aggregate([
+        {"$match": query},
+        {"$group": {"_id": group_id, "amount": {"$sum": "$amount"}, "entries": {"$sum": "$entries"}}},
+    ]).to_list(length=None)
+
+    buckets = {}
+    for row in rows:
+        key = row['_id']
+        bucket_key = (key['period'], key.get('site_id'))
+        bucket = buckets.get(bucket_key)
+        if bucket is None:
+            bucket = buckets[bucket_key] = {
+                "key": key['period'],
+                **({"site_id": key['site_id']} if per_site else {}),
+                "total_material_cost": 0,
+                "total_labour_cost": 0,
+                "total_overhead_cost": 0,
+                "total_cost": 0,
+                "overheads_by_category": {},
+            }
+        bucket[f"total_{key['cost_type']}_cost"] += row['amount']
+        bucket['total_cost'] += row['amount']
+        if key['cost_type'] == "overhead":
+            categories = bucket['overheads_by_category']
+            categories[key['category']] = categories.get(key['category'], 0) + row['amount']
+
+    return {
+        "from": from_date,
+        "to": to_date,
+        "site_ids": sites,
+        "group_by": group_by,
+        "buckets": [buckets[key] for key in sorted(buckets, key=lambda key: (key[0], key[1] or ""))],
     }
 
 @app.get("/api/reports/inventory")
-async def get_inventory_report():
+async def get_inventory_report(request: Request, response: Response, as_of: Optional[str] = None):
+    """Stock and its value now, or at the end of `as_of` from the ledger and rate history."""
+    await check_etag(request, response, {"materials", "rates"})
     materials = await db.materials.find().to_list(length=None)
+    if as_of:
+        as_of = parse_day(as_of, "as_of")
+        await rate_index.refresh()
+        stocks = await asyncio.gather(*(stock_at(m['material_id'], as_of) for m in materials))
+        for material, (stock, _) in zip(materials, stocks):
+            rate = rate_index.rate_at("material", material['material_id'], as_of)
+            material['current_stock'] = stock
+            material['rate_per_unit'] = material['rate_per_unit'] if rate is None else rate
     
     total_stock_value = sum(m['current_stock'] * m['rate_per_unit'] for m in materials)
     low_stock_items = [m for m in materials if m['current_stock'] < 5]
     
     return {
+        "as_of": as_of,
         "materials": [serialize_doc(m) for m in materials],
         "total_stock_value": total_stock_value,
         "low_stock_items": [serialize_doc(m) for m in low_stock_items]
     }
 
 # EXCEL EXPORT ROUTES
-@app.get("/api/export/site/{site_id}")
-async def export_site_report(site_id: str):
-    site = await db.sites.find_one({"site_id": site_id})
-    if not site:
-        raise HTTPException(status_code=404, detail="Site not found")
-    
-    logs = await db.site_daily_logs.find({"site_id": site_id}).sort("log_date", 1).to_list(length=None)
-    overheads = await db.overheads.find({"site_id": site_id}).sort("date", 1).to_list(length=None)
+# Workbook generation is CPU-bound, so it runs in a process pool instead of on
+# the event loop. Workers read MongoDB through their own synchronous client
+# and write the finished workbook to a path chosen by the API process.
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+EXPORT_MAX_WORKERS = int(os.environ.get("EXPORT_MAX_WORKERS", os.cpu_count() or 1))
+EXPORT_JOB_TTL_SECONDS = int(os.environ.get("EXPORT_JOB_TTL_SECONDS", 3600))
+EXPORT_CACHE_DIR = os.environ.get("EXPORT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "painting_contractor_exports"))
+EXPORT_CACHE_MAX_BYTES = int(os.environ.get("EXPORT_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+# Bump when a workbook layout changes so stale cache entries are never served
+EXPORT_LAYOUT_VERSION = 2
+
+export_pool = None
+export_slots = asyncio.Semaphore(EXPORT_MAX_WORKERS)
+export_jobs = {}
+export_tasks = set()
+_worker_client = None
+
+def worker_db(db_name):
+    """Per-process pymongo client for export workers."""
+    global _worker_client
+    if _worker_client is None:
+        _worker_client = MongoClient(MONGO_URL, serverSelectionTimeoutMS=5000)
+    return _worker_client[db_name]
+
+def styled_cell(ws, value, font=None, fill=None):
+    cell = WriteOnlyCell(ws, value=value)
+    if font:
+        cell.font = font
+    if fill:
+        cell.fill = fill
+    return cell
+
+def site_export_stats(export_db, site_id):
+    """Longest value per export column, so widths are known before any row is written.
+
+    Write-only worksheets emit their column definitions ahead of the first
+    row, so the widths cannot be measured while the rows stream past.
+    """
+    log_pipeline = [
+        {"$match": {"site_id": site_id}},
+        {"$group": {
+            "_id": None,
+            "total_material_cost": {"$sum": "$total_material_cost"},
+            "total_labour_cost": {"$sum": "$total_labour_cost"},
+            "max_material_cost": {"$max": "$total_material_cost"},
+            "max_labour_cost": {"$max": "$total_labour_cost"},
+            "max_total_cost": {"$max": "$total_cost"},
+            "max_notes": {"$max": {"$strLenCP": {"$ifNull": ["$notes", ""]}}},
+        }},
+    ]
+    overhead_pipeline = [
+        {"$match": {"site_id": site_id}},
+        {"$group": {
+            "_id": None,
+            "total_overhead_cost": {"$sum": "$amount"},
+            "max_amount": {"$max": "$amount"},
+            "max_category": {"$max": {"$strLenCP": "$category"}},
+            "max_description": {"$max": {"$strLenCP": {"$ifNull": ["$description", ""]}}},
+        }},
+    ]
+    log_stats = next(export_db.site_daily_logs.aggregate(log_pipeline), {})
+    overhead_stats = next(export_db.overheads.aggregate(overhead_pipeline), {})
+    return log_stats, overhead_stats
+
+def site_export_widths(site, log_stats, overhead_stats):
+    def length(value):
+        return len(str(value)) if value else 0
+
+    grand_total = sum(
+        stats.get(field, 0)
+        for stats, field in ((log_stats, "total_material_cost"), (log_stats, "total_labour_cost"),
+                             (overhead_stats, "total_overhead_cost"))
+    )
+    columns = [
+        [length(f"Site Name: {site['name']}"), length(f"Owner: {site['owner_name']}"),
+         length(f"Location: {site['location']}"), length(f"Status: {site['status']}"),
+         length("Total Overhead Cost:"), length("Site Report"), len("YYYY-MM-DD")],
+        [length("Materials Cost"), overhead_stats.get("max_category", 0),
+         length(log_stats.get("max_material_cost")), length(grand_total),
+         length(log_stats.get("total_material_cost")), length(log_stats.get("total_labour_cost")),
+         length(overhead_stats.get("total_overhead_cost"))],
+        [length("Labour Cost"), length(log_stats.get("max_labour_cost")), length(overhead_stats.get("max_amount"))],
+        [length("Description"), length(log_stats.get("max_total_cost")), overhead_stats.get("max_description", 0)],
+        [length("Notes"), log_stats.get("max_notes", 0)],
+    ]
+    return [max(column) + 2 for column in columns]
+
+def build_site_report(export_db, site, path):
+    """Stream a site's logs and overheads into a write-only workbook at `path`.
+
+    Rows go from the Mongo cursor to openpyxl's on-disk sheet writer one at a
+    time, so memory stays flat no matter how many years of logs the site has.
+    """
+    site_id = site['site_id']
+    log_stats, overhead_stats = site_export_stats(export_db, site_id)
     
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "Site Report"
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Site Report")
+    for col, width in enumerate(site_export_widths(site, log_stats, overhead_stats), start=1):
+        ws.column_dimensions[get_column_letter(col)].width = width
     
     # Header styling
     header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
     header_font = Font(color="FFFFFF", bold=True)
+    section_font = Font(size=14, bold=True)
     
     # Site Information
-    ws['A1'] = "Site Report"
-    ws['A1'].font = Font(size=16, bold=True)
-    ws['A2'] = f"Site Name: {site['name']}"
-    ws['A3'] = f"Owner: {site['owner_name']}"
-    ws['A4'] = f"Location: {site['location']}"
-    ws['A5'] = f"Status: {site['status']}"
-    ws['A6'] = ""
+    ws.append([styled_cell(ws, "Site Report", font=Font(size=16, bold=True))])
+    ws.append([f"Site Name: {site['name']}"])
+    ws.append([f"Owner: {site['owner_name']}"])
+    ws.append([f"Location: {site['location']}"])
+    ws.append([f"Status: {site['status']}"])
+    ws.append([])
     
     # Daily Logs Section
-    row = 7
-    ws[f'A{row}'] = "Daily Logs"
-    ws[f'A{row}'].font = Font(size=14, bold=True)
-    row += 1
-    
+    ws.append([styled_cell(ws, "Daily Logs", font=section_font)])
     headers = ['Date', 'Materials Cost', 'Labour Cost', 'Total Cost', 'Notes']
-    for col, header in enumerate(headers, start=1):
-        cell = ws.cell(row=row, column=col, value=header)
-        cell.fill = header_fill
-        cell.font = header_font
+    ws.append([styled_cell(ws, header, font=header_font, fill=header_fill) for header in headers])
     
-    row += 1
     total_material = 0
     total_labour = 0
+    logs = export_db.site_daily_logs.find({"site_id": site_id}).sort("log_date", 1).batch_size(STREAM_BATCH_SIZE)
     for log in logs:
-        ws.cell(row=row, column=1, value=log['log_date'])
-        ws.cell(row=row, column=2, value=log['total_material_cost'])
-        ws.cell(row=row, column=3, value=log['total_labour_cost'])
-        ws.cell(row=row, column=4, value=log['total_cost'])
-        ws.cell(row=row, column=5, value=log.get('notes', ''))
+        ws.append([log['log_date'], log['total_material_cost'], log['total_labour_cost'],
+                   log['total_cost'], log.get('notes', '')])
         total_material += log['total_material_cost']
         total_labour += log['total_labour_cost']
-        row += 1
     
     # Overheads Section
-    row += 1
-    ws[f'A{row}'] = "Overheads"
-    ws[f'A{row}'].font = Font(size=14, bold=True)
-    row += 1
-    
+    ws.append([])
+    ws.append([styled_cell(ws, "Overheads", font=section_font)])
     headers = ['Date', 'Category', 'Amount', 'Description']
-    for col, header in enumerate(headers, start=1):
-        cell = ws.cell(row=row, column=col, value=header)
-        cell.fill = header_fill
-        cell.font = header_font
+    ws.append([styled_cell(ws, header, font=header_font, fill=header_fill) for header in headers])
     
-    row += 1
     total_overhead = 0
+    overheads = export_db.overheads.find({"site_id": site_id}).sort("date", 1).batch_size(STREAM_BATCH_SIZE)
     for overhead in overheads:
-        ws.cell(row=row, column=1, value=overhead['date'])
-        ws.cell(row=row, column=2, value=overhead['category'])
-        ws.cell(row=row, column=3, value=overhead['amount'])
-        ws.cell(row=row, column=4, value=overhead.get('description', ''))
+        ws.append([overhead['date'], overhead['category'], overhead['amount'], overhead.get('description', '')])
         total_overhead += overhead['amount']
-        row += 1
     
     # Summary
-    row += 1
-    ws[f'A{row}'] = "Summary"
-    ws[f'A{row}'].font = Font(size=14, bold=True)
-    row += 1
-    ws[f'A{row}'] = "Total Material Cost:"
-    ws[f'B{row}'] = total_material
-    ws[f'B{row}'].font = Font(bold=True)
-    row += 1
-    ws[f'A{row}'] = "Total Labour Cost:"
-    ws[f'B{row}'] = total_labour
-    ws[f'B{row}'].font = Font(bold=True)
-    row += 1
-    ws[f'A{row}'] = "Total Overhead Cost:"
-    ws[f'B{row}'] = total_overhead
-    ws[f'B{row}'].font = Font(bold=True)
-    row += 1
-    ws[f'A{row}'] = "Grand Total:"
-    ws[f'B{row}'] = total_material + total_labour + total_overhead
-    ws[f'A{row}'].font = Font(size=12, bold=True)
-    ws[f'B{row}'].font = Font(size=12, bold=True, color="FF0000")
-    
-    # Auto-adjust column widths
-    for col in ws.columns:
-        max_length = 0
-        column = col[0].column_letter
-        for cell in col:
-            if cell.value:
-                max_length = max(max_length, len(str(cell.value)))
-        ws.column_dimensions[column].width = max_length + 2
-    
-    output = io.BytesIO()
-    wb.save(output)
-    output.seek(0)
+    ws.append([])
+    ws.append([styled_cell(ws, "Summary", font=section_font)])
+    ws.append(["Total Material Cost:", styled_cell(ws, total_material, font=Font(bold=True))])
+    ws.append(["Total Labour Cost:", styled_cell(ws, total_labour, font=Font(bold=True))])
+    ws.append(["Total Overhead Cost:", styled_cell(ws, total_overhead, font=Font(bold=True))])
+    ws.append([
+        styled_cell(ws, "Grand Total:", font=Font(size=12, bold=True)),
+        styled_cell(ws, total_material + total_labour + total_overhead, font=Font(size=12, bold=True, color="FF0000")),
+    ])
     
-    return StreamingResponse(
-        output,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": f"attachment; filename=site_report_{site['name']}.xlsx"}
-    )
+    wb.save(path)
 
-@app.get("/api/export/inventory")
-async def export_inventory_report():
-    materials = await db.materials.find().to_list(length=None)
+def build_inventory_report(export_db, path):
+    materials = list(export_db.materials.find())
+    # Cached until the materials version changes, so date it by that version
+    version = export_db.data_versions.find_one({"_id": "materials"}) or {}
     
     wb = openpyxl.Workbook()
     ws = wb.active
@@ -543,7 +2766,7 @@ async def export_inventory_report():
     
     ws['A1'] = "Central Material Inventory Report"
     ws['A1'].font = Font(size=16, bold=True)
-    ws['A2'] = f"Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+    ws['A2'] = f"Data as of: {version['updated_at'].strftime('%Y-%m-%d %H:%M')}" if 'updated_at' in version else ""
     ws['A3'] = ""
     
     headers = ['Material Name', 'Unit', 'Rate per Unit', 'Current Stock', 'Stock Value']
@@ -578,20 +2801,472 @@ async def export_inventory_report():
                 max_length = max(max_length, len(str(cell.value)))
         ws.column_dimensions[column].width = max_length + 2
     
-    output = io.BytesIO()
-    wb.save(output)
-    output.seek(0)
-    
+    wb.save(path)
+
+def build_export(kind, site_id, path, db_name):
+    """Process pool entry point."""
+    export_db = worker_db(db_name)
+    if kind == "site":
+        site = export_db.sites.find_one({"site_id": site_id})
+        if not site:
+            raise LookupError(f"Site {site_id} not found")
+        build_site_report(export_db, site, path)
+    else:
+        build_inventory_report(export_db, path)
+
+async def generate_export(kind, site_id=None):
+    """Build an export in the process pool and return the path of the new file.
+
+    Callers hold one of the EXPORT_MAX_WORKERS `export_slots` while this runs.
+    """
+    fd, path = tempfile.mkstemp(suffix=".xlsx.tmp", dir=EXPORT_CACHE_DIR)
+    os.close(fd)
+    started = time.perf_counter()
+    outcome = "failed"
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            export_pool, build_export, kind, site_id, path, db.name
+        )
+        outcome = "succeeded"
+    except BaseException:
+        os.remove(path)
+        raise
+    finally:
+        EXPORT_DURATION.labels(kind, outcome).observe(time.perf_counter() - started)
+    return path
+
+# Export cache. Workbooks are stored under a content address derived from the
+# export kind, the site and the data version of everything they are built
+# from, so an unchanged site is served straight from disk and any write makes
+# the old entry unreachable. Entries are evicted least recently used first
+# once EXPORT_CACHE_MAX_BYTES is exceeded.
+async def export_cache_key(kind, site_id=None):
+    version = await data_version(f"site:{site_id}" if kind == "site" else "materials")
+    source = f"{EXPORT_LAYOUT_VERSION}:{db.name}:{kind}:{site_id}:{version}"
+    return hashlib.sha256(source.encode()).hexdigest()
+
+def export_cache_get(key):
+    path = os.path.join(EXPORT_CACHE_DIR, f"{key}.xlsx")
+    try:
+        os.utime(path)  # mark as recently used
+    except FileNotFoundError:
+        return None
+    return path
+
+def export_cache_put(key, new_path):
+    path = os.path.join(EXPORT_CACHE_DIR, f"{key}.xlsx")
+    os.replace(new_path, path)
+    evict_export_cache(keep=path)
+    return path
+
+def evict_export_cache(keep=None):
+    entries = []
+    with os.scandir(EXPORT_CACHE_DIR) as it:
+        for entry in it:
+            if entry.name.endswith(".xlsx"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= EXPORT_CACHE_MAX_BYTES:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+async def cached_export(kind, key, site_id=None, on_start=None):
+    """Return the cached workbook for `key`, building it in the pool on a miss."""
+    path = export_cache_get(key)
+    if path:
+        return path
+    async with export_slots:
+        # Another request may have built it while this one waited for a slot
+        path = export_cache_get(key)
+        if path:
+            return path
+        if on_start:
+            on_start()
+        new_path = await generate_export(kind, site_id)
+    return export_cache_put(key, new_path)
+
+def export_filename(site=None):
+    return f"site_report_{site['name']}.xlsx" if site else "inventory_report.xlsx"
+
+def export_file_response(path, filename, etag):
+    return FileResponse(
+        path,
+        media_type=XLSX_MEDIA_TYPE,
+        headers={
+            "Content-Disposition": f"attachment; filename={filename}",
+            "ETag": etag,
+            "Cache-Control": "private, no-cache",
+        },
+    )
+
+@app.get("/api/export/site/{site_id}")
+async def export_site_report(site_id: str, request: Request):
+    site = await db.sites.find_one({"site_id": site_id}, {"name": 1})
+    if not site:
+        raise HTTPException(status_code=404, detail="Site not found")
+    key = await export_cache_key("site", site_id)
+    etag = f'"{key}"'
+    if not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    path = await cached_export("site", key, site_id)
+    return export_file_response(path, export_filename(site), etag)
+
+@app.get("/api/export/inventory")
+async def export_inventory_report(request: Request):
+    key = await export_cache_key("inventory")
+    etag = f'"{key}"'
+    if not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    path = await cached_export("inventory", key)
+    return export_file_response(path, export_filename(), etag)
+
+# Analytics export. Logs and overheads are flattened into one long fact
+# table, one row per material line, labour line or overhead, and streamed as
+# Arrow IPC or Parquet. Rows are collected into record batches straight from
+# the Mongo cursors and each batch is encoded and sent before the next is
+# read, so memory stays flat however long the date range is.
+ANALYTICS_BATCH_ROWS = int(os.environ.get("ANALYTICS_BATCH_ROWS", 50_000))
+ANALYTICS_FORMATS = {
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+ANALYTICS_SCHEMA = pa.schema([
+    ("date", pa.date32()),
+    ("site_id", pa.string()),
+    ("site_name", pa.string()),
+    ("line_type", pa.string()),  # material, labour, overhead
+    ("source_id", pa.string()),  # log_id or overhead_id
+    ("item_id", pa.string()),  # material_id or labour_id; None for overheads
+    ("item_name", pa.string()),  # material or labour name, overhead category
+    ("quantity", pa.float64()),  # material quantity or labour count
+    ("unit_rate", pa.float64()),  # rate_per_unit or rate_per_day
+    ("cost", pa.float64()),
+])
+ANALYTICS_LOG_FIELDS = {"log_id": 1, "site_id": 1, "site_name": 1, "log_date": 1, "materials_used": 1, "labours_used": 1}
+ANALYTICS_OVERHEAD_FIELDS = {"overhead_id": 1, "site_id": 1, "site_name": 1, "date": 1, "category": 1, "amount": 1}
+
+def analytics_log_rows(log):
+    base = (log['log_date'], log['site_id'], log['site_name'])
+    for material in log.get('materials_used', []):
+        yield base + ("material", log['log_id'], material['material_id'], material['material_name'],
+                      material['quantity'], material['rate_per_unit'], material['total_cost'])
+    for labour in log.get('labours_used', []):
+        yield base + ("labour", log['log_id'], labour['labour_id'], labour['labour_name'],
+                      labour['count'], labour['rate_per_day'], labour['total_cost'])
+
+def analytics_overhead_rows(overhead):
+    yield (overhead['date'], overhead['site_id'], overhead['site_name'], "overhead", overhead['overhead_id'],
+           None, overhead['category'], None, None, overhead['amount'])
+
+def analytics_batch(rows):
+    """Build a record batch from row tuples in ANALYTICS_SCHEMA order"""
+    columns = list(zip(*rows))
+    arrays = [pa.array(columns[0], type=pa.string()).cast(pa.date32())]
+    for column, column_type in zip(columns[1:], ANALYTICS_SCHEMA.types[1:]):
+        arrays.append(pa.array(column, type=column_type))
+    return pa.RecordBatch.from_arrays(arrays, schema=ANALYTICS_SCHEMA)
+
+class ChunkSink:
+    """Write-only file object whose output is drained after every batch.
+
+    tell() keeps counting across drains, which the Parquet writer relies on
+    for the offsets in its footer.
+    """
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+async def analytics_chunks(sources, file_format):
+    sink = ChunkSink()
+    if file_format == "parquet":
+        writer = pq.ParquetWriter(sink, ANALYTICS_SCHEMA, compression="zstd")
+    else:
+        writer = pa.ipc.new_stream(sink, ANALYTICS_SCHEMA)
+    rows = []
+    for cursor, flatten in sources:
+        async for doc in cursor:
+            rows.extend(flatten(doc))
+            if len(rows) >= ANALYTICS_BATCH_ROWS:
+                writer.write_batch(analytics_batch(rows))
+                rows = []
+                yield sink.drain()
+    if rows:
+        writer.write_batch(analytics_batch(rows))
+    writer.close()
+    yield sink.drain()
+
+@app.get("/api/export/analytics")
+async def export_analytics(
+    format: Literal["arrow", "parquet"] = "arrow",
+    from_date: Optional[str] = Query(None, alias="from"),
+    to_date: Optional[str] = Query(None, alias="to"),
+    site_ids: Optional[str] = None,
+):
+    """Material, labour and overhead lines as a long Arrow IPC stream or Parquet file."""
+    from_date = parse_day(from_date, "from")
+    to_date = parse_day(to_date, "to")
+    sites = parse_site_ids(site_ids)
+
+    log_query, overhead_query = {}, {}
+    if from_date or to_date:
+        log_query["log_date"] = overhead_query["date"] = day_range(from_date, to_date)
+    if sites:
+        log_query["site_id"] = overhead_query["site_id"] = {"$in": sites}
+    sources = [
+        (db.site_daily_logs.find(log_query, ANALYTICS_LOG_FIELDS).batch_size(STREAM_BATCH_SIZE),
+         analytics_log_rows),
+        (db.overheads.find(overhead_query, ANALYTICS_OVERHEAD_FIELDS).batch_size(STREAM_BATCH_SIZE),
+         analytics_overhead_rows),
+    ]
+
+    media_type, extension = ANALYTICS_FORMATS[format]
     return StreamingResponse(
-        output,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": "attachment; filename=inventory_report.xlsx"}
+        analytics_chunks(sources, format),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename=cost_lines.{extension}"},
     )
 
+# Background export jobs. Job state lives in this API process, so with several
+# uvicorn workers a client must poll the worker that accepted the job (use a
+# sticky session or a single worker for the jobs API).
+class ExportRequest(BaseModel):
+    kind: Literal["site", "inventory"]
+    site_id: Optional[str] = None
+
+def export_job_view(job):
+    return {key: value for key, value in job.items() if key not in ("path", "cache_key")}
+
+def prune_export_jobs():
+    # Files belong to the export cache; only the job records expire here
+    cutoff = datetime.now().timestamp() - EXPORT_JOB_TTL_SECONDS
+    for job_id, job in list(export_jobs.items()):
+        if job['finished_at'] and datetime.fromisoformat(job['finished_at']).timestamp() < cutoff:
+            del export_jobs[job_id]
+
+async def run_export_job(job):
+    def mark_running():
+        job['status'] = "running"
+
+    try:
+        job['cache_key'] = await export_cache_key(job['kind'], job['site_id'])
+        job['path'] = await cached_export(job['kind'], job['cache_key'], job['site_id'], on_start=mark_running)
+        job['status'] = "done"
+    except Exception as e:
+        logger.exception("Export job %s failed", job['job_id'])
+        job['status'] = "failed"
+        job['error'] = str(e)
+    job['finished_at'] = datetime.now().isoformat()
+
+@app.post("/api/exports", status_code=202)
+async def create_export_job(export: ExportRequest):
+    site = None
+    if export.kind == "site":
+        site = export.site_id and await db.sites.find_one({"site_id": export.site_id}, {"name": 1})
+        if not site:
+            raise HTTPException(status_code=404, detail="Site not found")
+    prune_export_jobs()
+    job = {
+        "job_id": str(uuid.uuid4()),
+        "kind": export.kind,
+        "site_id": export.site_id,
+        "status": "queued",
+        "filename": export_filename(site),
+        "error": None,
+        "path": None,
+        "cache_key": None,
+        "created_at": datetime.now().isoformat(),
+        "finished_at": None,
+    }
+    export_jobs[job['job_id']] = job
+    task = asyncio.create_task(run_export_job(job))
+    export_tasks.add(task)
+    task.add_done_callback(export_tasks.discard)
+    return export_job_view(job)
+
+@app.get("/api/exports/{job_id}")
+async def get_export_job(job_id: str):
+    job = export_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Export job not found")
+    return export_job_view(job)
+
+@app.get("/api/exports/{job_id}/download")
+async def download_export_job(job_id: str):
+    job = export_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Export job not found")
+    if job['status'] != "done":
+        raise HTTPException(status_code=409, detail=f"Export job is {job['status']}")
+    if not export_cache_get(job['cache_key']):
+        raise HTTPException(status_code=410, detail="Export file was evicted; start a new export")
+    return export_file_response(job['path'], job['filename'], f'"{job["cache_key"]}"')
+
+# ADMIN ROUTES
+@app.get("/api/admin/indexes")
+async def get_index_status():
+    """Compare the live indexes against INDEX_SPECS."""
+    live = {}
+    for collection in {spec["collection"] for spec in INDEX_SPECS}:
+        info = await db[collection].index_information()
+        live[collection] = {
+            name: [(field, int(direction)) for field, direction in index["key"]]
+            for name, index in info.items()
+        }
+
+    indexes = []
+    for spec in INDEX_SPECS:
+        keys = [(field, int(direction)) for field, direction in spec["keys"]]
+        indexes.append({
+            "collection": spec["collection"],
+            "name": _index_name(spec["keys"]),
+            "keys": dict(keys),
+            "unique": spec.get("unique", False),
+            "present": keys in live[spec["collection"]].values(),
+        })
+
+    return {
+        "indexes": indexes,
+        "missing": [index for index in indexes if not index["present"]],
+    }
+
+@app.get("/api/admin/cache")
+async def get_cache_stats():
+    return {
+        "ttl_seconds": reference_cache.ttl,
+        "max_entries": reference_cache.max_entries,
+        "collections": reference_cache.snapshot(),
+    }
+
+@app.get("/api/admin/profiles")
+async def list_profiles():
+    if not profiler:
+        return {"enabled": False, "profiles": []}
+    summary_fields = ("profile_id", "method", "path", "route", "status", "captured_at", "duration_ms",
+                      "overlapping_requests", "samples", "mongo_commands_total", "mongo_time_ms")
+    return {
+        "enabled": True,
+        "threshold_ms": PROFILE_SLOW_REQUEST_MS,
+        "profiles": [{field: profile[field] for field in summary_fields} for profile in reversed(profiler.profiles)],
+    }
+
+@app.get("/api/admin/profiles/{profile_id}")
+async def get_profile(profile_id: str):
+    for profile in list(profiler.profiles if profiler else []):
+        if profile['profile_id'] == profile_id:
+            return profile
+    raise HTTPException(status_code=404, detail="Profile not found")
+
+@app.get("/api/admin/rollups/verify")
+async def verify_site_cost_rollups():
+    return await reconcile_site_cost_rollups(fix=False)
+
+@app.post("/api/admin/rollups/rebuild")
+async def rebuild_site_cost_rollups():
+    return await reconcile_site_cost_rollups(fix=True)
+
+@app.get("/api/admin/costs/verify")
+async def verify_log_costs():
+    return await recost_logs(fix=False)
+
+@app.post("/api/admin/costs/rebuild")
+async def rebuild_log_costs():
+    return await recost_logs(fix=True)
+
+@app.post("/api/admin/cost-facts/backfill")
+async def backfill_cost_facts():
+    return await backfill_daily_cost_facts()
+
+@app.post("/api/admin/stock/compact")
+async def compact_stock(as_of: Optional[str] = None):
+    return await compact_stock_snapshots(as_of)
+
+@app.post("/api/admin/sync/prune")
+async def prune_sync():
+    return await prune_sync_history()
+
+@app.get("/metrics")
+async def get_metrics():
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 @app.get("/api/health")
 async def health_check():
     return {"status": "healthy", "message": "Painting Contractor API is running"}
 
+@app.get("/api/ready")
+async def readiness_check():
+    """Live ping plus connection pool health; 503 when MongoDB is unreachable."""
+    started = time.perf_counter()
+    try:
+        await client.admin.command('ping')
+    except PyMongoError as e:
+        return JSONResponse(status_code=503, content={
+            "status": "unavailable",
+            "error": str(e),
+            "pool": {**MONGO_POOL_OPTIONS, **pool_monitor.snapshot()},
+        })
+    return {
+        "status": "ready",
+        "ping_ms": (time.perf_counter() - started) * 1000,
+        "pool": {**MONGO_POOL_OPTIONS, **pool_monitor.snapshot()},
+    }
+
+# Maintenance commands, run as `python server.py <command>`
+COMMANDS = {
+    "verify-rollups": lambda: reconcile_site_cost_rollups(fix=False),
+    "rebuild-rollups": lambda: reconcile_site_cost_rollups(fix=True),
+    "compact-stock": lambda: compact_stock_snapshots(),
+    "prune-sync": lambda: prune_sync_history(),
+    "backfill-cost-facts": lambda: backfill_daily_cost_facts(),
+    "verify-log-costs": lambda: recost_logs(fix=False),
+    "rebuild-log-costs": lambda: recost_logs(fix=True),
+}
+
+async def run_command(name):
+    await startup_event()
+    try:
+        result = await COMMANDS[name]()
+    finally:
+        await shutdown_event()
+    print(json.dumps(result, indent=2, default=str))
+
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
+    if len(sys.argv) > 1:
+        if sys.argv[1] not in COMMANDS:
+            sys.exit(f"Unknown command {sys.argv[1]!r}. Available: {', '.join(COMMANDS)}")
+        asyncio.run(run_command(sys.argv[1]))
+    else:
+        import uvicorn
+        uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
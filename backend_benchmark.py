@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Site Report Benchmark for Painting Contractor App
+Compares the old Python-side summing in get_site_report against the MongoDB
+$group aggregation pipelines at 10k, 100k and 1M logs per site.
+
+Needs a reachable MongoDB (MONGO_URL, default mongodb://localhost:27017).
+Data is seeded into a scratch database that is dropped afterwards.
+"""
+
+import argparse
+import asyncio
+import math
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+from datetime import date, timedelta
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+import server  # noqa: E402
+
+MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
+BENCH_DB = "painting_contractor_benchmark"
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+SEED_BATCH = 10_000
+OVERHEADS_PER_LOG = 0.2
+
+
+async def python_site_totals(site_id):
+    """get_site_report totals as computed before the aggregation rewrite"""
+    logs = await server.db.site_daily_logs.find({"site_id": site_id}).to_list(length=None)
+    overheads = await server.db.overheads.find({"site_id": site_id}).to_list(length=None)
+    return {
+        "total_material_cost": sum(log['total_material_cost'] for log in logs),
+        "total_labour_cost": sum(log['total_labour_cost'] for log in logs),
+        "total_overhead_cost": sum(overhead['amount'] for overhead in overheads),
+        "logs_count": len(logs),
+        "overheads_count": len(overheads),
+    }
+
+
+def make_log(site_id, log_date):
+    """A daily log shaped like the ones the frontend posts"""
+    materials_used = []
+    for i in range(random.randint(1, 4)):
+        quantity = random.randint(1, 10)
+        rate = random.choice([450.0, 800.0, 1200.0, 2350.0])
+        materials_used.append({
+            "material_id": f"material-{i}",
+            "material_name": f"Paint {i}",
+            "quantity": quantity,
+            "rate_per_unit": rate,
+            "total_cost": quantity * rate,
+        })
+    labours_used = []
+    for i in range(random.randint(1, 3)):
+        count = random.randint(1, 6)
+        labours_used.append({
+            "labour_id": f"labour-{i}",
+            "labour_name": f"Crew {i}",
+            "count": count,
+            "rate_per_day": 800.0,
+            "total_cost": count * 800.0,
+        })
+    material_cost = sum(m['total_cost'] for m in materials_used)
+    labour_cost = sum(l['total_cost'] for l in labours_used)
+    return {
+        "log_id": str(uuid.uuid4()),
+        "site_id": site_id,
+        "site_name": "Benchmark Site",
+        "log_date": log_date,
+        "materials_used": materials_used,
+        "labours_used": labours_used,
+        "notes": "Second coat on the east wall, primer on ceilings",
+        "total_material_cost": material_cost,
+        "total_labour_cost": labour_cost,
+        "total_cost": material_cost + labour_cost,
+    }
+
+
+def make_overhead(site_id, overhead_date):
+    return {
+        "overhead_id": str(uuid.uuid4()),
+        "site_id": site_id,
+        "site_name": "Benchmark Site",
+        "date": overhead_date,
+        "category": random.choice(["Transport", "Food", "Scaffolding", "Miscellaneous"]),
+        "amount": float(random.randint(100, 5000)),
+    }
+
+
+async def seed_site(site_id, log_count):
+    start = date(2015, 1, 1)
+    overhead_count = int(log_count * OVERHEADS_PER_LOG)
+    for offset in range(0, log_count, SEED_BATCH):
+        batch = [
+            make_log(site_id, (start + timedelta(days=i // 10)).isoformat())
+            for i in range(offset, min(offset + SEED_BATCH, log_count))
+        ]
+        await server.db.site_daily_logs.insert_many(batch, ordered=False)
+    for offset in range(0, overhead_count, SEED_BATCH):
+        batch = [
+            make_overhead(site_id, (start + timedelta(days=i // 2)).isoformat())
+            for i in range(offset, min(offset + SEED_BATCH, overhead_count))
+        ]
+        await server.db.overheads.insert_many(batch, ordered=False)
+
+
+async def time_call(fn, site_id, repeat):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = await fn(site_id)
+        samples.append((time.perf_counter() - started) * 1000)
+    return result, samples
+
+
+def same_totals(a, b):
+    return all(math.isclose(a[key], b[key], rel_tol=1e-9) for key in a)
+
+
+async def run(sizes, repeat):
+    client = AsyncIOMotorClient(MONGO_URL, serverSelectionTimeoutMS=5000)
+    server.db = client[BENCH_DB]
+    await server.ensure_indexes()
+
+    print("🚀 get_site_report benchmark: Python sums vs aggregation pipeline")
+    print("=" * 80)
+    print(f"{'logs/site':>12} {'python p50 ms':>15} {'aggregate p50 ms':>18} {'speedup':>9}")
+    try:
+        for size in sizes:
+            site_id = str(uuid.uuid4())
+            await seed_site(site_id, size)
+
+            legacy, legacy_ms = await time_call(python_site_totals, site_id, repeat)
+            aggregated, aggregated_ms = await time_call(server.site_cost_totals, site_id, repeat)
+            if not same_totals(legacy, aggregated):
+                print(f"❌ Totals differ at {size} logs: {legacy} != {aggregated}")
+                return False
+
+            legacy_p50 = statistics.median(legacy_ms)
+            aggregated_p50 = statistics.median(aggregated_ms)
+            print(f"{size:>12,} {legacy_p50:>15.1f} {aggregated_p50:>18.1f} {legacy_p50 / aggregated_p50:>8.1f}x")
+    finally:
+        await client.drop_database(BENCH_DB)
+        client.close()
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="logs per site to benchmark")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per implementation")
+    args = parser.parse_args()
+    success = asyncio.run(run(args.sizes, args.repeat))
+    sys.exit(0 if success else 1)
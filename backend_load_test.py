@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+API Load Test for Painting Contractor App
+Seeds a realistic dataset (sites x days x materials) through the bulk import
+endpoints, then drives concurrent load on log creation, the list endpoints,
+the dashboard, the reports and the Excel exports. Reports throughput and
+latency percentiles per scenario and can compare them with a baseline saved
+from an earlier run on the same machine.
+
+The app runs in-process and is called through httpx's ASGI transport, so the
+numbers cover the handlers, middleware and MongoDB but not uvicorn or the
+network. By default it uses the MongoDB at MONGO_URL (default
+mongodb://localhost:27017) and a scratch database that is dropped afterwards.
+--in-memory uses mongomock-motor instead; the export scenarios are skipped
+there because export workers read MongoDB from separate processes.
+
+    python backend_load_test.py --save-baseline load_baseline.json
+    python backend_load_test.py --baseline load_baseline.json
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+import httpx
+
+LOAD_DB = "painting_contractor_loadtest"
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ["MONGO_DB_NAME"] = LOAD_DB
+# Keep cached exports out of the server's own cache directory
+os.environ.setdefault("EXPORT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "painting_contractor_loadtest_exports"))
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+import server  # noqa: E402
+
+SEED_CHUNK = 1000
+START_DATE = date(2025, 1, 1)
+PERCENTILES = (50, 90, 95, 99)
+EXPORT_SCENARIOS = ("export_site", "export_inventory")
+
+
+def make_log_payload(data, site, log_date):
+    """A daily log shaped like the ones the frontend posts"""
+    materials_used = []
+    for material in random.sample(data['materials'], random.randint(1, 4)):
+        quantity = random.randint(1, 5)
+        materials_used.append({
+            "material_id": material['material_id'],
+            "material_name": material['name'],
+            "quantity": quantity,
+            "rate_per_unit": material['rate_per_unit'],
+            "total_cost": quantity * material['rate_per_unit'],
+        })
+    labours_used = []
+    for labour in random.sample(data['labours'], random.randint(1, 3)):
+        count = random.randint(1, 6)
+        labours_used.append({
+            "labour_id": labour['labour_id'],
+            "labour_name": labour['name'],
+            "count": count,
+            "rate_per_day": labour['rate_per_day'],
+            "total_cost": count * labour['rate_per_day'],
+        })
+    return {
+        "site_id": site['site_id'],
+        "site_name": site['name'],
+        "log_date": log_date,
+        "materials_used": materials_used,
+        "labours_used": labours_used,
+        "notes": "Second coat on the east wall, primer on ceilings",
+    }
+
+
+async def bulk_post(http, path, rows):
+    for offset in range(0, len(rows), SEED_CHUNK):
+        response = await http.post(path, json=rows[offset:offset + SEED_CHUNK])
+        response.raise_for_status()
+        result = response.json()
+        if result['failed']:
+            raise RuntimeError(f"Seeding {path} failed: {result['errors'][:3]}")
+
+
+async def seed(http, sites, days, materials, labours):
+    await bulk_post(http, "/api/materials/bulk", [
+        {
+            "name": f"Paint {i}",
+            "unit": random.choice(["bucket", "liter", "kg", "piece"]),
+            "rate_per_unit": random.choice([450.0, 800.0, 1200.0, 2350.0]),
+            "current_stock": 1_000_000.0,
+        }
+        for i in range(materials)
+    ])
+    await bulk_post(http, "/api/labours/bulk", [
+        {"name": f"Crew {i}", "rate_per_day": random.choice([600.0, 800.0, 1000.0])}
+        for i in range(labours)
+    ])
+    for i in range(sites):
+        response = await http.post("/api/sites", json={
+            "name": f"Site {i}",
+            "owner_name": f"Owner {i}",
+            "owner_phone": "9876543210",
+            "location": f"{i} Main St, Mumbai",
+            "start_date": START_DATE.isoformat(),
+        })
+        response.raise_for_status()
+
+    data = {
+        "sites": (await http.get("/api/sites")).json(),
+        "materials": (await http.get("/api/materials")).json(),
+        "labours": (await http.get("/api/labours")).json(),
+        "dates": [(START_DATE + timedelta(days=day)).isoformat() for day in range(days)],
+    }
+    await bulk_post(http, "/api/site-logs/bulk", [
+        make_log_payload(data, site, log_date) for site in data['sites'] for log_date in data['dates']
+    ])
+    await bulk_post(http, "/api/overheads/bulk", [
+        {
+            "site_id": site['site_id'],
+            "site_name": site['name'],
+            "date": log_date,
+            "category": random.choice(["Transport", "Food", "Scaffolding", "Miscellaneous"]),
+            "amount": float(random.randint(100, 5000)),
+        }
+        for site in data['sites'] for log_date in data['dates'][::3]
+    ])
+    return data
+
+
+def build_scenarios(data):
+    def site_id():
+        return random.choice(data['sites'])['site_id']
+
+    return {
+        "create_site_log": lambda http: http.post("/api/site-logs", json=make_log_payload(
+            data, random.choice(data['sites']), random.choice(data['dates'])
+        )),
+        "list_sites": lambda http: http.get("/api/sites"),
+        "list_materials": lambda http: http.get("/api/materials"),
+        "list_labours": lambda http: http.get("/api/labours"),
+        "list_site_logs": lambda http: http.get("/api/site-logs", params={"site_id": site_id(), "limit": 100}),
+        "list_overheads": lambda http: http.get("/api/overheads", params={"limit": 100}),
+        "bootstrap": lambda http: http.get("/api/bootstrap"),
+        "report_site": lambda http: http.get(f"/api/reports/site/{site_id()}"),
+        "report_daily": lambda http: http.get("/api/reports/daily", params={"date": random.choice(data['dates'])}),
+        "report_inventory": lambda http: http.get("/api/reports/inventory"),
+        "export_site": lambda http: http.get(f"/api/export/site/{site_id()}"),
+        "export_inventory": lambda http: http.get("/api/export/inventory"),
+    }
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile"""
+    return sorted_values[max(0, math.ceil(pct / 100 * len(sorted_values)) - 1)]
+
+
+async def run_scenario(http, request, total, concurrency):
+    latencies = []
+    errors = 0
+    remaining = total
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            try:
+                response = await request(http)
+                failed = response.status_code >= 400
+            except httpx.HTTPError:
+                failed = True
+            latencies.append((time.perf_counter() - started) * 1000)
+            errors += failed
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    summary = {"requests": total, "errors": errors, "throughput_rps": total / elapsed}
+    for pct in PERCENTILES:
+        summary[f"p{pct}_ms"] = percentile(latencies, pct)
+    summary["max_ms"] = latencies[-1]
+    return summary
+
+
+def compare(results, baseline, tolerance):
+    """Print deltas against the baseline and return the regressed scenarios"""
+    regressions = []
+    print(f"\n📊 Compared with baseline from {baseline['created_at']} (tolerance {tolerance:.0%})")
+    if baseline['config'] != results['config']:
+        print(f"⚠️  Config differs from the baseline: {baseline['config']}")
+    for name, summary in results['results'].items():
+        base = baseline['results'].get(name)
+        if not base:
+            print(f"   {name:<18} no baseline")
+            continue
+        p95_change = summary['p95_ms'] / base['p95_ms'] - 1 if base['p95_ms'] else 0
+        rps_change = summary['throughput_rps'] / base['throughput_rps'] - 1
+        regressed = p95_change > tolerance or rps_change < -tolerance or summary['errors'] > base['errors']
+        print(f"{'❌' if regressed else '✅'} {name:<18} p95 {p95_change:+7.1%}   throughput {rps_change:+7.1%}")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+async def connect(in_memory):
+    if in_memory:
+        try:
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            sys.exit("--in-memory needs mongomock-motor: pip install -r backend/requirements.txt")
+        server.client = AsyncMongoMockClient()
+        server.db = server.client[LOAD_DB]
+    else:
+        await server.startup_event()
+    await server.client.drop_database(LOAD_DB)
+    await server.ensure_indexes()
+
+
+async def run(args):
+    random.seed(args.seed)
+    await connect(args.in_memory)
+    selected = args.scenarios or list(build_scenarios({}))
+    if args.in_memory:
+        selected = [name for name in selected if name not in EXPORT_SCENARIOS]
+
+    config = {
+        "mode": "in-memory" if args.in_memory else "mongod",
+        "sites": args.sites, "days": args.days, "materials": args.materials, "labours": args.labours,
+        "concurrency": args.concurrency, "requests": args.requests, "export_requests": args.export_requests,
+    }
+    transport = httpx.ASGITransport(app=server.app)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=300) as http:
+            print("🚀 Painting Contractor API load test")
+            print("=" * 80)
+            seed_started = time.perf_counter()
+            data = await seed(http, args.sites, args.days, args.materials, args.labours)
+            print(f"Seeded {args.sites} sites x {args.days} days ({args.sites * args.days:,} logs), "
+                  f"{args.materials} materials, {args.labours} labours "
+                  f"in {time.perf_counter() - seed_started:.1f}s\n")
+
+            scenarios = build_scenarios(data)
+            header = "".join(f"{f'p{pct} ms':>10}" for pct in PERCENTILES)
+            print(f"{'scenario':<18} {'reqs':>6} {'errors':>6} {'req/s':>9}{header} {'max ms':>10}")
+            results = {}
+            for name in selected:
+                total = args.export_requests if name in EXPORT_SCENARIOS else args.requests
+                summary = await run_scenario(http, scenarios[name], total, args.concurrency)
+                results[name] = summary
+                percentiles = "".join(f"{summary[f'p{pct}_ms']:>10.1f}" for pct in PERCENTILES)
+                print(f"{name:<18} {summary['requests']:>6} {summary['errors']:>6} "
+                      f"{summary['throughput_rps']:>9.1f}{percentiles} {summary['max_ms']:>10.1f}")
+    finally:
+        await server.client.drop_database(LOAD_DB)
+        if not args.in_memory:
+            await server.shutdown_event()
+        server.client.close()
+
+    report = {"created_at": datetime.now().isoformat(), "config": config, "results": results}
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\n💾 Baseline written to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\n❌ Regressions: {', '.join(regressions)}")
+            return False
+    return not any(summary['errors'] for summary in results.values())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sites", type=int, default=20, help="sites to seed")
+    parser.add_argument("--days", type=int, default=90, help="daily logs per site")
+    parser.add_argument("--materials", type=int, default=30, help="materials to seed")
+    parser.add_argument("--labours", type=int, default=15, help="labourers to seed")
+    parser.add_argument("--concurrency", type=int, default=20, help="requests in flight per scenario")
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario")
+    parser.add_argument("--export-requests", type=int, default=40, help="requests per export scenario")
+    parser.add_argument("--scenarios", nargs="+", choices=list(build_scenarios({})), help="run only these")
+    parser.add_argument("--in-memory", action="store_true", help="use mongomock-motor instead of MONGO_URL")
+    parser.add_argument("--seed", type=int, default=42, help="random seed for the dataset and requests")
+    parser.add_argument("--save-baseline", metavar="PATH", help="write the results as a baseline")
+    parser.add_argument("--baseline", metavar="PATH", help="compare with a baseline; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed p95 increase / throughput drop before failing (default 0.2)")
+    args = parser.parse_args()
+    success = asyncio.run(run(args))
+    sys.exit(0 if success else 1)
@@ -6,13 +6,21 @@ Tests all CRUD operations, stock management, reports, and Excel exports
 
 import requests
 import json
+import os
 import sys
+import uuid
 from datetime import datetime, date
 import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
 # Backend URL from frontend/.env
 BASE_URL = "https://paintpro-tracker.preview.emergentagent.com/api"
 
+# Concurrency stress test sizing
+STRESS_LOG_POSTS = 2000
+STRESS_WORKERS = 50
+
 class PaintingContractorAPITester:
     def __init__(self):
         self.base_url = BASE_URL
@@ -523,6 +531,316 @@ class PaintingContractorAPITester:
         except Exception as e:
             self.log_result("Create Second Daily Log", False, f"Error: {str(e)}")
 
+    def test_concurrent_stock_updates(self):
+        """Stress test: thousands of parallel log posts against one material"""
+        print("=== TESTING CONCURRENT STOCK UPDATES ===")
+        
+        if not self.test_data['sites']:
+            self.log_result("Concurrent Stock Test", False, "Missing prerequisite data (sites)")
+            return
+        
+        site = self.test_data['sites'][0]
+        initial_stock = float(STRESS_LOG_POSTS * 2)
+        material_data = {
+            "name": "Stress Test Primer",
+            "unit": "liter",
+            "rate_per_unit": 10.0,
+            "current_stock": initial_stock
+        }
+        try:
+            response = requests.post(f"{self.base_url}/materials", json=material_data, timeout=10)
+            if response.status_code != 200:
+                self.log_result("Concurrent Stock Test", False, f"Status: {response.status_code}", response.text)
+                return
+            material = response.json()
+        except Exception as e:
+            self.log_result("Concurrent Stock Test", False, f"Error: {str(e)}")
+            return
+        
+        def post_log(i):
+            log_data = {
+                "site_id": site['site_id'],
+                "site_name": site['name'],
+                "log_date": "2025-02-01",
+                "materials_used": [{
+                    "material_id": material['material_id'],
+                    "material_name": material['name'],
+                    "quantity": 1.0,
+                    "rate_per_unit": material['rate_per_unit'],
+                    "total_cost": material['rate_per_unit']
+                }],
+                "notes": f"Stress log {i}"
+            }
+            try:
+                response = requests.post(f"{self.base_url}/site-logs", json=log_data, timeout=30)
+                return response.json()['log_id'] if response.status_code == 200 else None
+            except Exception:
+                return None
+        
+        def delete_log(log_id):
+            try:
+                return requests.delete(f"{self.base_url}/site-logs/{log_id}", timeout=30).status_code == 200
+            except Exception:
+                return False
+        
+        with ThreadPoolExecutor(max_workers=STRESS_WORKERS) as pool:
+            log_ids = [log_id for log_id in pool.map(post_log, range(STRESS_LOG_POSTS)) if log_id]
+        
+        expected_stock = initial_stock - len(log_ids)
+        actual_stock = self.get_material_stock(material['material_id'])
+        self.log_result("Concurrent Stock Reduction", actual_stock == expected_stock,
+                      f"{len(log_ids)}/{STRESS_LOG_POSTS} posts succeeded, "
+                      f"stock: {initial_stock} → {actual_stock} (expected: {expected_stock})")
+        
+        with ThreadPoolExecutor(max_workers=STRESS_WORKERS) as pool:
+            deleted = sum(pool.map(delete_log, log_ids))
+        
+        expected_stock = initial_stock - (len(log_ids) - deleted)
+        actual_stock = self.get_material_stock(material['material_id'])
+        self.log_result("Concurrent Stock Restoration", actual_stock == expected_stock,
+                      f"{deleted}/{len(log_ids)} deletes succeeded, "
+                      f"stock: {actual_stock} (expected: {expected_stock})")
+        
+        requests.delete(f"{self.base_url}/materials/{material['material_id']}", timeout=10)
+
+    def test_backdated_stock_ledger(self):
+        """A log dated before a material was created must not drive its past stock negative"""
+        print("=== TESTING BACKDATED STOCK LEDGER ===")
+        
+        if not self.test_data['sites']:
+            self.log_result("Backdated Stock Ledger", False, "Missing prerequisite data (sites)")
+            return
+        
+        site = self.test_data['sites'][0]
+        try:
+            material = requests.post(f"{self.base_url}/materials", json={
+                "name": "Backdated Test Thinner",
+                "unit": "liter",
+                "rate_per_unit": 50.0,
+                "current_stock": 10.0
+            }, timeout=10).json()
+            log = requests.post(f"{self.base_url}/site-logs", json={
+                "site_id": site['site_id'],
+                "site_name": site['name'],
+                "log_date": "2025-01-02",
+                "materials_used": [{
+                    "material_id": material['material_id'],
+                    "material_name": material['name'],
+                    "quantity": 3.0
+                }],
+                "notes": "Backdated ledger test log"
+            }, timeout=10).json()
+            
+            stock_url = f"{self.base_url}/materials/{material['material_id']}/stock"
+            past = requests.get(stock_url, params={"as_of": "2025-01-03"}, timeout=10).json()['stock']
+            today = requests.get(stock_url, timeout=10).json()['stock']
+            self.log_result("Backdated Stock Ledger", past == 7.0 and today == 7.0,
+                          f"Stock on 2025-01-03: {past} (expected: 7.0), today: {today} (expected: 7.0)")
+            
+            requests.delete(f"{self.base_url}/site-logs/{log['log_id']}", timeout=10)
+            requests.delete(f"{self.base_url}/materials/{material['material_id']}", timeout=10)
+        except Exception as e:
+            self.log_result("Backdated Stock Ledger", False, f"Error: {str(e)}")
+
+    def test_rate_history_and_reprice(self):
+        """Effective-dated rates: backdated pricing, dry runs and bounded reprices"""
+        print("=== TESTING RATE HISTORY AND REPRICE ===")
+        
+        if not self.test_data['sites']:
+            self.log_result("Rate History Test", False, "Missing prerequisite data (sites)")
+            return
+        
+        site = self.test_data['sites'][0]
+        try:
+            material = requests.post(f"{self.base_url}/materials", json={
+                "name": "Reprice Test Putty",
+                "unit": "kg",
+                "rate_per_unit": 10.0,
+                "current_stock": 100.0
+            }, timeout=10).json()
+            reprice_url = f"{self.base_url}/materials/{material['material_id']}/reprice"
+            rates_url = f"{self.base_url}/materials/{material['material_id']}/rates"
+            
+            def post_log(log_date, quantity):
+                # No rate on the line: the server prices it at the rate in effect on log_date
+                return requests.post(f"{self.base_url}/site-logs", json={
+                    "site_id": site['site_id'],
+                    "site_name": site['name'],
+                    "log_date": log_date,
+                    "materials_used": [{
+                        "material_id": material['material_id'],
+                        "material_name": material['name'],
+                        "quantity": quantity
+                    }],
+                    "notes": "Reprice test log"
+                }, timeout=10).json()
+            
+            def line_rates():
+                logs = requests.get(f"{self.base_url}/site-logs", params={"site_id": site['site_id']}, timeout=10).json()
+                return {
+                    log['log_date']: (log['materials_used'][0]['rate_per_unit'], log['total_material_cost'])
+                    for log in logs if log['log_id'] in log_ids
+                }
+            
+            log_ids = []
+            response = requests.post(reprice_url, json={"rate": 12.0, "from_date": "2025-05-15"}, timeout=30)
+            for log_date in ("2025-05-01", "2025-05-20", "2025-06-15"):
+                log_ids.append(post_log(log_date, 2.0)['log_id'])
+            
+            expected = {"2025-05-01": (10.0, 20.0), "2025-05-20": (12.0, 24.0), "2025-06-15": (12.0, 24.0)}
+            actual = line_rates()
+            self.log_result("Log Priced At Effective Rate", response.status_code == 200 and actual == expected,
+                          f"(rate, cost) by log date: {actual} (expected: {expected})")
+            
+            history = requests.get(rates_url, timeout=10).json()['rates']
+            response = requests.post(reprice_url, json={"rate": 99.0, "from_date": "2025-05-01", "dry_run": True}, timeout=30)
+            result = response.json()
+            unchanged = requests.get(rates_url, timeout=10).json()['rates'] == history and line_rates() == expected
+            self.log_result("Reprice Dry Run", response.status_code == 200 and result['changed_logs'] == 3 and unchanged,
+                          f"Would change {result.get('changed_logs')} logs, history and logs unchanged: {unchanged}")
+            
+            response = requests.post(reprice_url, json={"rate": 15.0, "from_date": "2025-05-18", "to_date": "2025-05-31"}, timeout=30)
+            resumed = requests.get(rates_url, params={"as_of": "2025-06-01"}, timeout=10).json()['rate']
+            expected = {"2025-05-01": (10.0, 20.0), "2025-05-20": (15.0, 30.0), "2025-06-15": (12.0, 24.0)}
+            actual = line_rates()
+            self.log_result("Reprice Date Range", response.status_code == 200 and resumed == 12.0 and actual == expected,
+                          f"Rate on 2025-06-01: {resumed} (expected: 12.0), (rate, cost) by log date: {actual}")
+            
+            # The reprice rewrote line costs and totals; the cost engine must agree with them
+            response = requests.get(f"{self.base_url}/admin/costs/verify", timeout=120)
+            result = response.json()
+            self.log_result("Cost Verification After Reprice",
+                          response.status_code == 200 and result['changed_logs'] == 0,
+                          f"Checked {result.get('checked_logs')} logs, drifted: {result.get('changed_logs')}",
+                          result.get('samples'))
+            
+            for log_id in log_ids:
+                requests.delete(f"{self.base_url}/site-logs/{log_id}", timeout=10)
+            requests.delete(f"{self.base_url}/materials/{material['material_id']}", timeout=10)
+        except Exception as e:
+            self.log_result("Rate History Test", False, f"Error: {str(e)}")
+
+    def test_cascading_site_delete(self):
+        """Site delete must remove its logs, overheads and restore nothing else"""
+        print("=== TESTING CASCADING SITE DELETE ===")
+        
+        site_data = {
+            "name": "Cascade Test Site",
+            "owner_name": "Test Owner",
+            "owner_phone": "9000000000",
+            "location": "Test Location",
+            "start_date": "2025-03-01",
+            "status": "Running"
+        }
+        try:
+            site = requests.post(f"{self.base_url}/sites", json=site_data, timeout=10).json()
+            requests.post(f"{self.base_url}/site-logs", json={
+                "site_id": site['site_id'],
+                "site_name": site['name'],
+                "log_date": "2025-03-01",
+                "notes": "Cascade test log"
+            }, timeout=10)
+            requests.post(f"{self.base_url}/overheads", json={
+                "site_id": site['site_id'],
+                "site_name": site['name'],
+                "date": "2025-03-01",
+                "category": "Transport",
+                "amount": 500.0
+            }, timeout=10)
+            
+            response = requests.delete(f"{self.base_url}/sites/{site['site_id']}", timeout=10)
+            logs = requests.get(f"{self.base_url}/site-logs", params={"site_id": site['site_id']}, timeout=10).json()
+            overheads = requests.get(f"{self.base_url}/overheads", params={"site_id": site['site_id']}, timeout=10).json()
+            report = requests.get(f"{self.base_url}/reports/site/{site['site_id']}", timeout=10)
+            
+            no_orphans = response.status_code == 200 and not logs and not overheads and report.status_code == 404
+            self.log_result("Cascading Site Delete", no_orphans,
+                          f"Remaining logs: {len(logs)}, overheads: {len(overheads)}, report status: {report.status_code}")
+        except Exception as e:
+            self.log_result("Cascading Site Delete", False, f"Error: {str(e)}")
+
+    def test_rollup_consistency(self):
+        """Site cost rollups must match the raw logs and overheads"""
+        print("=== TESTING ROLLUP CONSISTENCY ===")
+        
+        try:
+            response = requests.get(f"{self.base_url}/admin/rollups/verify", timeout=30)
+            if response.status_code == 200:
+                result = response.json()
+                self.log_result("Rollup Consistency", not result['drift'],
+                              f"Checked {result['checked']} sites, drift: {len(result['drift'])}",
+                              result['drift'])
+            else:
+                self.log_result("Rollup Consistency", False, f"Status: {response.status_code}", response.text)
+        except Exception as e:
+            self.log_result("Rollup Consistency", False, f"Error: {str(e)}")
+
+    def test_transaction_rollback(self):
+        """A failure inside a log write must leave log, stock, rollup and movements unchanged
+
+        Runs the app in-process against MONGO_URL (a replica set, see README)
+        in a scratch database, so the failure can be forced mid-transaction.
+        """
+        print("=== TESTING TRANSACTION ROLLBACK ===")
+        
+        if not os.environ.get("MONGO_URL"):
+            print("   Skipped: set MONGO_URL to a replica set to run it\n")
+            return
+        os.environ["MONGO_DB_NAME"] = f"rollback_test_{uuid.uuid4().hex[:8]}"
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+        import server
+        from fastapi.testclient import TestClient
+        
+        with TestClient(server.app, raise_server_exceptions=False) as client:
+            try:
+                if not server.transactions_supported:
+                    print("   Skipped: MONGO_URL is a standalone server without transactions\n")
+                    return
+                site = client.post("/api/sites", json={
+                    "name": "Rollback Test Site",
+                    "owner_name": "Test Owner",
+                    "owner_phone": "9000000000",
+                    "location": "Test Location",
+                    "start_date": "2025-04-01"
+                }).json()
+                material = client.post("/api/materials", json={
+                    "name": "Rollback Test Paint",
+                    "unit": "liter",
+                    "rate_per_unit": 100.0,
+                    "current_stock": 50.0
+                }).json()
+                
+                async def snapshot():
+                    db = server.db
+                    return {
+                        "logs": await db.site_daily_logs.count_documents({"site_id": site['site_id']}),
+                        "stock": (await db.materials.find_one({"material_id": material['material_id']}))['current_stock'],
+                        "rollup": await db.site_cost_rollups.find_one({"site_id": site['site_id']}, {"_id": 0}),
+                        "movements": await db.stock_movements.count_documents({"material_id": material['material_id']}),
+                    }
+                
+                before = client.portal.call(snapshot)
+                # Fail after the stock, movements and log are written, before the transaction commits
+                with mock.patch.object(server, "apply_rollup_incs", side_effect=RuntimeError("forced failure")):
+                    response = client.post("/api/site-logs", json={
+                        "site_id": site['site_id'],
+                        "site_name": site['name'],
+                        "log_date": "2025-04-01",
+                        "materials_used": [{
+                            "material_id": material['material_id'],
+                            "material_name": material['name'],
+                            "quantity": 5.0
+                        }]
+                    })
+                after = client.portal.call(snapshot)
+                
+                self.log_result("Transaction Rollback", response.status_code == 500 and after == before,
+                              f"Status: {response.status_code}, before: {before}, after: {after}")
+            except Exception as e:
+                self.log_result("Transaction Rollback", False, f"Error: {str(e)}")
+            finally:
+                client.portal.call(server.client.drop_database, server.MONGO_DB_NAME)
+
     def test_overheads_crud(self):
         """Test Overheads CRUD operations"""
         print("=== TESTING OVERHEADS CRUD ===")
@@ -761,9 +1079,15 @@ class PaintingContractorAPITester:
         self.test_materials_crud()
         self.test_labours_crud()
         self.test_daily_logs_with_stock_management()  # Critical tests
+        self.test_concurrent_stock_updates()
+        self.test_backdated_stock_ledger()
+        self.test_rate_history_and_reprice()
         self.test_overheads_crud()
         self.test_reports_api()
         self.test_excel_exports()
+        self.test_cascading_site_delete()
+        self.test_rollup_consistency()
+        self.test_transaction_rollback()
         
         # Optional cleanup
         # self.cleanup_test_data()
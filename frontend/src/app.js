@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import './app.css';
 
 const API_URL = process.env.REACT_APP_API_URL || 'http://localhost:8001';
@@ -10,6 +10,9 @@ function App() {
   const [labours, setLabours] = useState([]);
   const [dailyLogs, setDailyLogs] = useState([]);
   const [overheads, setOverheads] = useState([]);
+  const [logsCount, setLogsCount] = useState(0);
+  const [totalMaterialValue, setTotalMaterialValue] = useState(0);
+  const syncSeq = useRef(0);
   const [loading, setLoading] = useState(false);
   
   // Report states
@@ -47,25 +50,66 @@ function App() {
   const fetchAllData = async () => {
     setLoading(true);
     try {
-      const [sitesRes, materialsRes, laboursRes, logsRes, overheadsRes] = await Promise.all([
-        fetch(`${API_URL}/api/sites`),
-        fetch(`${API_URL}/api/materials`),
-        fetch(`${API_URL}/api/labours`),
-        fetch(`${API_URL}/api/site-logs`),
-        fetch(`${API_URL}/api/overheads`),
-      ]);
-
-      if (sitesRes.ok) setSites(await sitesRes.json());
-      if (materialsRes.ok) setMaterials(await materialsRes.json());
-      if (laboursRes.ok) setLabours(await laboursRes.json());
-      if (logsRes.ok) setDailyLogs(await logsRes.json());
-      if (overheadsRes.ok) setOverheads(await overheadsRes.json());
+      const res = await fetch(`${API_URL}/api/bootstrap`);
+      if (res.ok) {
+        const data = await res.json();
+        setSites(data.sites);
+        setMaterials(data.materials);
+        setLabours(data.labours);
+        setDailyLogs(data.recent_logs);
+        setOverheads(data.recent_overheads);
+        setLogsCount(data.logs_count);
+        setTotalMaterialValue(data.total_material_value);
+        syncSeq.current = data.seq;
+      }
     } catch (error) {
       console.error('Error fetching data:', error);
     }
     setLoading(false);
   };
 
+  // Apply deletions first, then replace or add the changed documents
+  const mergeChanges = (items, changed, deleted, idKey, sortKey) => {
+    const removed = new Set(deleted);
+    const byId = new Map(items.filter((item) => !removed.has(item[idKey])).map((item) => [item[idKey], item]));
+    changed.forEach((item) => byId.set(item[idKey], item));
+    const merged = Array.from(byId.values());
+    return sortKey ? merged.sort((a, b) => b[sortKey].localeCompare(a[sortKey])) : merged;
+  };
+
+  // After a mutation, fetch only what changed since the last bootstrap or sync
+  const syncData = async () => {
+    try {
+      // Collect every page; deletes come before changes across the pages too
+      const changes = { sites: [], materials: [], labours: [], site_logs: [], overheads: [] };
+      const deleted = { sites: [], materials: [], labours: [], site_logs: [], overheads: [] };
+      let page;
+      let after = null;
+      do {
+        const res = await fetch(`${API_URL}/api/sync?since=${syncSeq.current}${after ? `&after=${after}` : ''}`);
+        if (!res.ok) return fetchAllData();
+        page = await res.json();
+        Object.keys(changes).forEach((name) => {
+          changes[name].push(...page.changes[name]);
+          deleted[name].push(...page.deleted[name]);
+        });
+        after = page.next;
+      } while (after);
+      const { seq, logs_count } = page;
+      const nextMaterials = mergeChanges(materials, changes.materials, deleted.materials, 'material_id');
+      setSites(mergeChanges(sites, changes.sites, deleted.sites, 'site_id'));
+      setMaterials(nextMaterials);
+      setLabours(mergeChanges(labours, changes.labours, deleted.labours, 'labour_id'));
+      setDailyLogs(mergeChanges(dailyLogs, changes.site_logs, deleted.site_logs, 'log_id', 'log_date'));
+      setOverheads(mergeChanges(overheads, changes.overheads, deleted.overheads, 'overhead_id', 'date'));
+      setLogsCount(logs_count);
+      setTotalMaterialValue(nextMaterials.reduce((sum, m) => sum + (m.rate_per_unit * m.current_stock || 0), 0));
+      syncSeq.current = seq;
+    } catch (error) {
+      console.error('Error syncing data:', error);
+    }
+  };
+
   const addSite = async (e) => {
     e.preventDefault();
     if (!siteForm.name || !siteForm.owner_name || !siteForm.owner_phone || !siteForm.location || !siteForm.start_date) return;
@@ -77,7 +121,7 @@ function App() {
       });
       if (res.ok) {
         setSiteForm({ name: '', owner_name: '', owner_phone: '', owner_email: '', location: '', start_date: '', status: 'Running' });
-        fetchAllData();
+        syncData();
       }
     } catch (error) {
       console.error('Error adding site:', error);
@@ -100,7 +144,7 @@ function App() {
       });
       if (res.ok) {
         setMaterialForm({ name: '', unit: 'bucket', rate_per_unit: '', current_stock: '' });
-        fetchAllData();
+        syncData();
       }
     } catch (error) {
       console.error('Error adding material:', error);
@@ -121,7 +165,7 @@ function App() {
       });
       if (res.ok) {
         setLabourForm({ name: '', rate_per_day: '' });
-        fetchAllData();
+        syncData();
       }
     } catch (error) {
       console.error('Error adding labour:', error);
@@ -200,7 +244,7 @@ function App() {
       });
       if (res.ok) {
         cancelEditMaterial();
-        fetchAllData();
+        syncData();
       } else {
         alert('Failed to update material');
       }
@@ -216,7 +260,7 @@ function App() {
           method: 'DELETE',
         });
         if (res.ok) {
-          fetchAllData();
+          syncData();
         } else {
           alert('Failed to delete material');
         }
@@ -257,7 +301,7 @@ function App() {
       });
       if (res.ok) {
         cancelEditSite();
-        fetchAllData();
+        syncData();
       } else {
         alert('Failed to update site');
       }
@@ -273,7 +317,7 @@ function App() {
           method: 'DELETE',
         });
         if (res.ok) {
-          fetchAllData();
+          syncData();
         } else {
           alert('Failed to delete site');
         }
@@ -309,7 +353,7 @@ function App() {
       });
       if (res.ok) {
         cancelEditLabour();
-        fetchAllData();
+        syncData();
       } else {
         alert('Failed to update labour');
       }
@@ -325,7 +369,7 @@ function App() {
           method: 'DELETE',
         });
         if (res.ok) {
-          fetchAllData();
+          syncData();
         } else {
           alert('Failed to delete labourer');
         }
@@ -339,8 +383,6 @@ function App() {
     fetchAllData();
   }, []);
 
-  const totalMaterialValue = materials.reduce((sum, m) => sum + (m.rate_per_unit * m.current_stock || 0), 0);
-
   return (
     <div className="min-h-screen bg-gray-50">
       <header className="bg-white shadow">
@@ -384,7 +426,7 @@ function App() {
             </div>
             <div className="bg-white p-6 rounded-lg shadow">
               <h3 className="text-lg font-semibold">Daily Logs</h3>
-              <p className="text-3xl font-bold text-orange-600">{dailyLogs.length}</p>
+              <p className="text-3xl font-bold text-orange-600">{logsCount}</p>
             </div>
           </div>
         )}